@@ -1,6 +1,8 @@
-from datetime import datetime, timedelta
-from flask import Flask, render_template, render_template_string, request, redirect, url_for, send_from_directory, flash
+from datetime import date, datetime, timedelta
+from flask import Flask, render_template, render_template_string, request, redirect, url_for, send_from_directory, send_file, flash, jsonify, g, abort
 from flask_sqlalchemy import SQLAlchemy
+import sqlalchemy
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 import os
 import re
 import json
@@ -8,7 +10,27 @@ import time
 import threading  # Import threading module
 import random
 import subprocess
-from PIL import Image
+import shutil
+import tempfile
+import hashlib
+import struct
+import gzip
+import zlib
+import heapq
+import math
+import statistics
+from collections import deque
+from types import SimpleNamespace
+import pickle
+import select
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from PIL import Image, ImageOps
+
+# Advisory file locks elect the process that runs the background services (Unix only)
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 app = Flask(__name__)
 app.secret_key = 'your_secret_key'
@@ -21,18 +43,126 @@ CACHE_FILE_PATH = '/home/dietpi/imageserver/image_cache.json'
 # Cache duration (24 hours)
 CACHE_DURATION = 24 * 60 * 60  # in seconds (24 hours)
 
+# Longest time the event thread sleeps before checking its queue again (1 hour)
+EVENT_MAX_SLEEP = 60 * 60  # in seconds
+
+# Number of files probed in parallel while indexing, mostly waiting on the network share
+INDEX_WORKERS = 16
+
+# Number of frames rendered in parallel
+RENDER_WORKERS = os.cpu_count() or 1
+# Time a single render may take before it is given up on (5 minutes)
+RENDER_TIMEOUT = 5 * 60  # in seconds
+
+# Lead time before a wake-up time when no render durations were measured yet (5 minutes)
+RENDER_LEAD_DEFAULT = 5 * 60  # in seconds
+# The lead time is the longest recent render duration times this factor, plus the margin
+RENDER_LEAD_FACTOR = 2
+RENDER_LEAD_MARGIN = 60  # in seconds
+# Number of recent render durations kept per screen type
+RENDER_DURATION_SAMPLES = 20
+# Longest time the scheduler sleeps before checking its renders again (1 hour)
+RENDER_SCHEDULE_MAX_SLEEP = 60 * 60  # in seconds
+
+# Folder holding images rendered ahead of time, one subfolder per frame
+RENDER_QUEUE_PATH = os.path.join(os.path.dirname(__file__), 'render_queue')
+# Number of rendered images kept ready per frame
+RENDER_QUEUE_SIZE = 2
+# Time between checks for render queues that need refilling (5 minutes)
+RENDER_AHEAD_INTERVAL = 5 * 60  # in seconds
+# Niceness of the thread that refills the render queues
+RENDER_AHEAD_NICENESS = 10
+
+# Folder holding rendered payloads keyed by source image, screen type and script
+RENDER_CACHE_PATH = os.path.join(os.path.dirname(__file__), 'render_cache')
+# Maximum size of the render cache, least recently used renders are removed first (256 MB)
+RENDER_CACHE_MAX_BYTES = 256 * 1024 * 1024  # in bytes
+
+# Lock file held by the one process that runs the background services, the others take over when it is released
+LEADER_LOCK_PATH = os.path.join(os.path.dirname(__file__), 'imageserver.lock')
+# Touched on every configuration change, so every process notices changes made through the others
+CONFIG_VERSION_PATH = os.path.join(os.path.dirname(__file__), 'config_version')
+# How often a waiting process tries to take over, and how often the leader checks for changes from the others
+LEADER_POLL_INTERVAL = 10  # in seconds
+# Set IMAGESERVER_BACKGROUND_SERVICES=0 to import the app without the scheduler, event and render-ahead threads (e.g. for benchmarks)
+BACKGROUND_SERVICES = os.environ.get('IMAGESERVER_BACKGROUND_SERVICES', '1') != '0'
+
+# Dither algorithms a screen type can use, passed to its script; scripts without the option always use the default
+DITHER_ALGORITHMS = ['floyd-steinberg', 'atkinson', 'ordered']
+DEFAULT_DITHER = 'floyd-steinberg'
+
+# Images per page of /api/images, and the most a client may ask for
+IMAGES_PAGE_SIZE = 100
+IMAGES_PAGE_SIZE_MAX = 500
+# Folder holding generated thumbnails, keyed by source image and size
+THUMBNAIL_CACHE_PATH = os.path.join(os.path.dirname(__file__), 'thumbnail_cache')
+# Longest side of a thumbnail in pixels
+THUMBNAIL_SIZE = 160
+# Maximum size of the thumbnail cache, least recently used thumbnails are removed first (64 MB)
+THUMBNAIL_CACHE_MAX_BYTES = 64 * 1024 * 1024  # in bytes
+# Thumbnail URLs carry the source file's mtime, so browsers can keep them for long
+THUMBNAIL_MAX_AGE = 365 * 24 * 60 * 60  # in seconds
+
+# Folder holding resized /random_image variants keyed by source image, size and format
+IMAGE_VARIANT_CACHE_PATH = os.path.join(os.path.dirname(__file__), 'variant_cache')
+# Maximum size of the variant cache, least recently used variants are removed first (128 MB)
+IMAGE_VARIANT_CACHE_MAX_BYTES = 128 * 1024 * 1024  # in bytes
+# Largest width or height a client may ask for
+IMAGE_VARIANT_MAX_SIZE = 4096  # in pixels
+# Formats a variant can be sent in: PIL format, file extension and mimetype
+IMAGE_VARIANT_FORMATS = {
+    'jpeg': ('JPEG', '.jpg', 'image/jpeg'),
+    'png': ('PNG', '.png', 'image/png'),
+    'webp': ('WEBP', '.webp', 'image/webp')
+}
+
+# Upper bounds in seconds of the histogram buckets on /metrics
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+# Number of payload fetches remembered per frame for the fetch telemetry, in the frame_fetch table
+FRAME_FETCH_HISTORY = 64
+# A fetch this close to a wake-up time belongs to that wake-up, otherwise the wake-up counts as missed
+FRAME_FETCH_WINDOW = 10 * 60  # in seconds
+
 SHARED_IMAGES_BASE = SHARED_IMAGES_PATH
 LOCAL_IMAGES_BASE = LOCAL_IMAGES_PATH
 
 # Define the path to the static folder
 STATIC_FOLDER_PATH = os.path.join(os.path.dirname(__file__), 'static')
 
+# Seconds a write waits for another process or thread to finish its write before failing with "database is locked"
+SQLITE_BUSY_TIMEOUT = 15  # in seconds
+# Database connections kept open, enough for the request threads and the background services
+SQLITE_POOL_SIZE = 10
+# Image index changes staged per transaction, so a large re-index never holds the write lock for long
+INDEX_WRITE_BATCH = 500
+# Staged changes of an index run that did not finish are dropped after this long (1 day)
+INDEX_STAGING_MAX_AGE = 24 * 60 * 60  # in seconds
+
 # Database configuration
 db_path = os.path.join(os.path.dirname(__file__), 'imageserver.db')
 app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{db_path}'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'connect_args': {'timeout': SQLITE_BUSY_TIMEOUT},
+    'pool_size': SQLITE_POOL_SIZE,
+    'max_overflow': SQLITE_POOL_SIZE
+}
 db = SQLAlchemy(app)
 
+def configure_sqlite_connection(dbapi_connection, connection_record):
+    """Switches a new connection to WAL mode, so reads never wait for a write and a write never waits for reads.
+
+    With WAL, synchronous=NORMAL only syncs at checkpoints: a power cut can lose the last commits, but never corrupts the database.
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.close()
+
+with app.app_context():
+    sqlalchemy.event.listen(db.engine, 'connect', configure_sqlite_connection)
+
 # Association table for many-to-many relationship between events and frames
 event_frame_association = db.Table('event_frame',
     db.Column('event_id', db.Integer, db.ForeignKey('event.id'), primary_key=True),
@@ -49,6 +179,7 @@ class Event(db.Model):
     category_id = db.Column(db.Integer, db.ForeignKey('category.id'), nullable=True)
     category = db.relationship('Category', backref='events')
     frames = db.relationship('PhotoFrame', secondary=event_frame_association, backref='events')
+    updated_at = db.Column(db.DateTime, nullable=True, default=datetime.now)  # Time of the last add or edit, part of each transition's key
 
 # Association table for many-to-many relationship between external events and frames
 external_event_frame_association = db.Table('external_event_frame',
@@ -84,16 +215,69 @@ class PhotoFrame(db.Model):
     category_id = db.Column(db.Integer, db.ForeignKey('category.id'), nullable=True)  # Link to Category
     category = db.relationship('Category', backref='photo_frames')
 
+# Define the IndexedImage model, the persistent index of image files and their dimensions
+class IndexedImage(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    path = db.Column(db.String(1024), unique=True, nullable=False)
+    folder = db.Column(db.String(255), nullable=False, index=True)  # Format: "Shared - name" or "Local - name"
+    name = db.Column(db.String(255), nullable=False)
+    size = db.Column(db.BigInteger, nullable=False)
+    mtime = db.Column(db.BigInteger, nullable=False)  # In nanoseconds
+    width = db.Column(db.Integer, nullable=False)
+    height = db.Column(db.Integer, nullable=False)
+    orientation = db.Column(db.String(10), nullable=False)
+
+    # Pages of /api/images are sorted by folder and name
+    __table_args__ = (db.Index('ix_indexed_image_folder_name', 'folder', 'name'),)
+
+# Define the FrameFetch model, recent payload fetches per frame shared by all server processes
+class FrameFetch(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    frame_id_code = db.Column(db.String(3), nullable=False, index=True)
+    time = db.Column(db.Float, nullable=False)  # Unix time the request started
+    file_type = db.Column(db.String(8), nullable=False)  # h, bin or txt
+    bytes_sent = db.Column(db.Integer, nullable=False)
+    duration = db.Column(db.Float, nullable=False)  # In seconds
+    status = db.Column(db.Integer, nullable=False)
+    render_to_fetch = db.Column(db.Float, nullable=True)  # Seconds between the render and the end of the request
+    late_render = db.Column(db.Boolean, nullable=False)
+
+# Changes found by an image index run, staged in batches and applied to indexed_image in one transaction.
+# Rows of a run share its run_id (the start time in nanoseconds); removed rows only have a path.
+indexed_image_staging = db.Table('indexed_image_staging',
+    db.Column('run_id', db.BigInteger, nullable=False, index=True),
+    db.Column('path', db.String(1024), nullable=False),
+    db.Column('removed', db.Boolean, nullable=False),
+    db.Column('folder', db.String(255)),
+    db.Column('name', db.String(255)),
+    db.Column('size', db.BigInteger),
+    db.Column('mtime', db.BigInteger),
+    db.Column('width', db.Integer),
+    db.Column('height', db.Integer),
+    db.Column('orientation', db.String(10))
+)
+
 # Define the ScreenType model
 class ScreenType(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(50), nullable=False)
     script_filename = db.Column(db.String(100), nullable=False)
     orientation = db.Column(db.String(10), nullable=False)  # New field for orientation
+    dither = db.Column(db.String(20), nullable=False, default=DEFAULT_DITHER, server_default=DEFAULT_DITHER)  # Dither algorithm passed to the script
 
 # Create the database tables if they don't exist and add the default screen type
 with app.app_context():
     db.create_all()
+
+    # Add indexes and columns introduced after the database was created
+    for table_index in IndexedImage.__table__.indexes:
+        table_index.create(db.engine, checkfirst=True)
+    screen_type_columns = [row[1] for row in db.session.execute(db.text("PRAGMA table_info(screen_type)"))]
+    if 'dither' not in screen_type_columns:
+        db.session.execute(db.text(f"ALTER TABLE screen_type ADD COLUMN dither VARCHAR(20) NOT NULL DEFAULT '{DEFAULT_DITHER}'"))
+    event_columns = [row[1] for row in db.session.execute(db.text("PRAGMA table_info(event)"))]
+    if 'updated_at' not in event_columns:
+        db.session.execute(db.text("ALTER TABLE event ADD COLUMN updated_at DATETIME"))
     if not ScreenType.query.filter_by(name="6 Color Spectra 7.3 inch Horizontal").first():
         default_screen = ScreenType(name="6 Color Spectra 7.3 inch Horizontal", script_filename="6color73i.py", orientation="Horizontal")
         db.session.add(default_screen)
@@ -105,64 +289,352 @@ with app.app_context():
     
     db.session.commit()
 
-# Function to determine if an event is active based on today's date
-def is_event_active(event, current_date):
-    current_month = current_date.month
-    current_day = current_date.day
-
-    # Extract event start month and day
-    event_start_month, event_start_day = map(int, event.start_day_month.split('-'))
-
-    # Check if today's date matches the event's start date
-    return current_month == event_start_month and current_day == event_start_day
-
-# Function to determine if an event should end based on today's date
-def is_event_not_active(event, current_date):
-    current_month = current_date.month
-    current_day = current_date.day
+# Metrics served by /metrics in the Prometheus text format, keyed by name: {'type', 'help', 'labels', 'values'}
+metrics = {}
+metrics_lock = threading.Lock()
+
+def define_metric(name, metric_type, help_text, labels=()):
+    """Registers a counter, gauge or histogram with the names of its labels."""
+    metrics[name] = {'type': metric_type, 'help': help_text, 'labels': labels, 'values': {}}
+
+def inc_metric(name, labels=(), amount=1):
+    """Adds amount to a counter."""
+    with metrics_lock:
+        values = metrics[name]['values']
+        values[labels] = values.get(labels, 0) + amount
+
+def set_metric(name, value, labels=()):
+    """Sets a gauge."""
+    with metrics_lock:
+        metrics[name]['values'][labels] = value
+
+def observe_metric(name, value, labels=()):
+    """Records a value in a histogram as its bucket counts, sum and count."""
+    with metrics_lock:
+        values = metrics[name]['values']
+        bucket_counts, total, count = values.get(labels, ([0] * len(METRICS_BUCKETS), 0, 0))
+        bucket_counts = [bucket_count + (value <= bound) for bucket_count, bound in zip(bucket_counts, METRICS_BUCKETS)]
+        values[labels] = (bucket_counts, total + value, count + 1)
+
+def format_metric_labels(names, values):
+    """Formats label names and values as {name="value",...}, escaping the values."""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def format_metrics():
+    """Returns all metrics in the Prometheus text exposition format."""
+    lines = []
+    with metrics_lock:
+        for name, metric in metrics.items():
+            lines.append(f"# HELP {name} {metric['help']}")
+            lines.append(f"# TYPE {name} {metric['type']}")
+            label_names = metric['labels']
+            for labels, value in sorted(metric['values'].items()):
+                if metric['type'] != 'histogram':
+                    lines.append(f"{name}{format_metric_labels(label_names, labels)} {value}")
+                    continue
+
+                # Histogram buckets are cumulative and end with +Inf, which counts every value
+                bucket_counts, total, count = value
+                bucket_names = label_names + ('le',)
+                for bound, bucket_count in zip(METRICS_BUCKETS, bucket_counts):
+                    lines.append(f"{name}_bucket{format_metric_labels(bucket_names, labels + (bound,))} {bucket_count}")
+                lines.append(f"{name}_bucket{format_metric_labels(bucket_names, labels + ('+Inf',))} {count}")
+                lines.append(f"{name}_sum{format_metric_labels(label_names, labels)} {total}")
+                lines.append(f"{name}_count{format_metric_labels(label_names, labels)} {count}")
+    return '\n'.join(lines) + '\n'
+
+def log_record(record_type, **fields):
+    """Prints a structured log line: one JSON object with the time, record type and fields."""
+    print(json.dumps({'time': datetime.now().isoformat(timespec='milliseconds'), 'type': record_type, **fields}, default=str))
+
+define_metric('imageserver_render_stage_seconds', 'histogram', "Duration of each render stage (decode, resize, dither, encode, write) and of the whole render.", ('screen_type', 'stage'))
+define_metric('imageserver_render_failures_total', 'counter', "Renders that failed, per frame.", ('frame',))
+define_metric('imageserver_index_scan_seconds', 'histogram', "Duration of image index scans.")
+define_metric('imageserver_index_files', 'gauge', "Files found by the last image index scan, by result (indexed, probed, failed, removed).", ('result',))
+define_metric('imageserver_scheduler_lag_seconds', 'histogram', "Delay between the time a render was scheduled for and the time it started.")
+define_metric('imageserver_payload_bytes_served_total', 'counter', "Bytes of frame payloads served, by file type and content encoding.", ('file', 'encoding'))
+define_metric('imageserver_payload_requests_total', 'counter', "Requests for frame payloads, by file type and status code.", ('file', 'status'))
+
+# Read-only copy of the configuration (frames, screen types, categories and events with their frames),
+# shared by the scheduler and the list pages and rebuilt after the edit routes change it
+config_snapshot = None
+config_snapshot_version = None
+config_snapshot_generation = 0
+config_snapshot_lock = threading.Lock()
+
+def get_config_version():
+    """Returns the time of the last configuration change made by any process, in nanoseconds."""
+    try:
+        return os.stat(CONFIG_VERSION_PATH).st_mtime_ns
+    except OSError:
+        return 0
+
+def copy_row(row):
+    """Returns a plain copy of a model row's columns, safe to share between threads after its session is gone."""
+    return SimpleNamespace(**{column.key: getattr(row, column.key) for column in row.__table__.columns})
+
+def build_config_snapshot():
+    """Loads all frames, screen types, categories and events and links them, with a fixed number of queries."""
+    categories = [copy_row(row) for row in Category.query.order_by(Category.id)]
+    categories_by_id = {category.id: category for category in categories}
+    screen_types = [copy_row(row) for row in ScreenType.query.order_by(ScreenType.id)]
+    frames = [copy_row(row) for row in PhotoFrame.query.order_by(PhotoFrame.id)]
+    frames_by_id = {frame.id: frame for frame in frames}
+    for frame in frames:
+        frame.category = categories_by_id.get(frame.category_id)
+
+    def load_events(model, association, event_column):
+        events = [copy_row(row) for row in model.query.order_by(model.id)]
+        event_frames = {}
+        for event_id, frame_id in db.session.execute(db.select(association.c[event_column], association.c.frame_id)):
+            if frame_id in frames_by_id:
+                event_frames.setdefault(event_id, []).append(frames_by_id[frame_id])
+        for event in events:
+            event.category = categories_by_id.get(event.category_id)
+            event.frames = event_frames.get(event.id, [])
+        return events
+
+    return SimpleNamespace(
+        frames=frames,
+        frames_by_id=frames_by_id,
+        frames_by_code={frame.id_code: frame for frame in frames},
+        screen_types=screen_types,
+        screen_types_by_name={screen_type.name: screen_type for screen_type in screen_types},
+        categories=categories,
+        categories_by_id=categories_by_id,
+        events=load_events(Event, event_frame_association, 'event_id'),
+        external_events=load_events(ExternalEvent, external_event_frame_association, 'external_event_id')
+    )
+
+def get_config_snapshot():
+    """Returns the configuration snapshot, loading it if a write in this or another process invalidated it."""
+    global config_snapshot, config_snapshot_version
+    version = get_config_version()
+    with config_snapshot_lock:
+        if config_snapshot and config_snapshot_version == version:
+            return config_snapshot
+        generation = config_snapshot_generation
+
+    snapshot = build_config_snapshot()
+    with config_snapshot_lock:
+        # Only keep the snapshot if nothing was written while it was loaded
+        if generation == config_snapshot_generation:
+            config_snapshot = snapshot
+            config_snapshot_version = version
+    return snapshot
+
+def invalidate_config_snapshot():
+    """Drops the configuration snapshot, called after every commit that changes frames, screen types, categories or events."""
+    global config_snapshot, config_snapshot_generation
+    with config_snapshot_lock:
+        config_snapshot = None
+        config_snapshot_generation += 1
+
+    # Let the other processes know
+    try:
+        changed_at = time.time_ns()
+        with open(CONFIG_VERSION_PATH, 'a'):
+            pass
+        os.utime(CONFIG_VERSION_PATH, ns=(changed_at, changed_at))
+    except OSError as e:
+        print(f"Error updating {CONFIG_VERSION_PATH}: {e}")
+
+# Pending event transitions as a heap of (time, event id, action, MM-DD day, event updated_at), rebuilt when events change
+event_queue = []
+event_queue_dirty = True
+event_queue_condition = threading.Condition()
+# Transitions already applied as (event id, event updated_at, action, date), so each one is applied exactly once.
+# Adding or editing an event changes its updated_at in the database, so every process sees that the
+# event's transitions are new and the leader applies them again with the new settings.
+applied_event_transitions = set()
+
+def next_event_date(day_month, from_date):
+    """Returns the first date on or after from_date that falls on an MM-DD day, or None if it never does."""
+    month, day = map(int, day_month.split('-'))
+    for year in range(from_date.year, from_date.year + 9):  # Covers February 29
+        try:
+            candidate = date(year, month, day)
+        except ValueError:
+            continue
+        if candidate >= from_date:
+            return candidate
+    return None
 
-    # Extract event end month and day
-    event_end_month, event_end_day = map(int, event.end_day_month.split('-'))
+def schedule_event_transition(queue, event_id, action, day_month, updated_at, from_date):
+    """Pushes the next start or end of an event onto the queue, at midnight of its day."""
+    next_date = next_event_date(day_month, from_date) if day_month else None
+    if next_date:
+        heapq.heappush(queue, (datetime.combine(next_date, datetime.min.time()), event_id, action, day_month, updated_at))
+
+def build_event_queue(today):
+    """Computes the next start and end of every event."""
+    queue = []
+    for event in Event.query.all():
+        # A start and end on the same day leave the event active, as 'end' sorts before 'start'
+        schedule_event_transition(queue, event.id, 'start', event.start_day_month, event.updated_at, today)
+        schedule_event_transition(queue, event.id, 'end', event.end_day_month, event.updated_at, today)
+    return queue
+
+def rebuild_event_queue():
+    """Has check_events recompute its transitions, called when events are added, edited or deleted."""
+    global event_queue_dirty
+    with event_queue_condition:
+        event_queue_dirty = True
+        event_queue_condition.notify()
+
+def apply_event_transition(event, action):
+    """Switches the frames of an event to the event's category and times, or back when it ends."""
+    if action == 'start':
+        # Event is active
+        for frame in event.frames:
+            if frame.category_id != event.category_id:
+                invalidate_render_queue(frame.id_code)  # Queued renders are for the old category
+            frame.category_id = event.category_id
+            frame.active_wake_up_times = event.event_times  # Set wake-up times if applicable
+            db.session.add(frame)  # Track changes to the frame
+            
+            # Write updated active wake-up times to the corresponding file
+            write_wake_up_times_to_file(frame.id_code, frame.active_wake_up_times)
+        db.session.commit()
+        invalidate_config_snapshot()
+        rebuild_render_schedule()
 
-    # Check if today's date matches the event's end date
-    return current_month == event_end_month and current_day == event_end_day
+    else:
+        # Event is ending today
+        for frame in event.frames:
+            if frame.category_id is not None:
+                invalidate_render_queue(frame.id_code)  # Queued renders are for the event's category
+            frame.category_id = None  # Or set to a default category ID
+            frame.active_wake_up_times = frame.wake_up_times  # Reset to default wake-up times
+            db.session.add(frame)  # Track changes to the frame
+            
+            # Write reset wake-up times to the file
+            write_wake_up_times_to_file(frame.id_code, frame.active_wake_up_times)
+        db.session.commit()
+        invalidate_config_snapshot()
+        rebuild_render_schedule()
 
 # Function to check events and update photo frames
 def check_events():
+    """Sleeps until the next event start or end and applies it, instead of polling all events."""
+    global event_queue, event_queue_dirty
     while True:
+        with event_queue_condition:
+            if event_queue_dirty:
+                event_queue_dirty = False
+                try:
+                    with app.app_context():
+                        event_queue = build_event_queue(date.today())
+                except Exception as e:
+                    print(f"Error scheduling events: {e}")
+                    event_queue = []
+
+            now = datetime.now()
+            if not event_queue or event_queue[0][0] > now:
+                # Sleep until the next transition, waking up regularly in case the clock changed
+                timeout = EVENT_MAX_SLEEP
+                if event_queue:
+                    timeout = min(timeout, (event_queue[0][0] - now).total_seconds())
+                event_queue_condition.wait(timeout)
+                continue
+
+            when, event_id, action, day_month, updated_at = heapq.heappop(event_queue)
+            # Schedule the next occurrence, a year later
+            schedule_event_transition(event_queue, event_id, action, day_month, updated_at, when.date() + timedelta(days=1))
+
+        # Apply the transition unless it was already applied today for this version of the event
+        transition = (event_id, updated_at, action, when.date())
+        if transition in applied_event_transitions:
+            continue
+        applied_event_transitions.add(transition)
+
         with app.app_context():
-            current_date = datetime.now()
-            events = Event.query.all()
-            for event in events:
-                if is_event_active(event, current_date):
-                    # Event is active
-                    for frame in event.frames:
-                        frame.category_id = event.category_id
-                        frame.active_wake_up_times = event.event_times  # Set wake-up times if applicable
-                        db.session.add(frame)  # Track changes to the frame
-                        
-                        # Write updated active wake-up times to the corresponding file
-                        write_wake_up_times_to_file(frame.id_code, frame.active_wake_up_times)
-                    db.session.commit()
-                
-                elif is_event_not_active(event, current_date):
-                    # Event is ending today
-                    for frame in event.frames:
-                        frame.category_id = None  # Or set to a default category ID
-                        frame.active_wake_up_times = frame.wake_up_times  # Reset to default wake-up times
-                        db.session.add(frame)  # Track changes to the frame
-                        
-                        # Write reset wake-up times to the file
-                        write_wake_up_times_to_file(frame.id_code, frame.active_wake_up_times)
-                    db.session.commit()
-
-        # Sleep for 10 minutes
-        time.sleep(150)  # 150 seconds
-
-# Start the background thread when the app starts
-event_thread = threading.Thread(target=check_events)
-event_thread.daemon = True  # Daemonize thread
-event_thread.start()
+            try:
+                event = Event.query.get(event_id)
+                if event:
+                    apply_event_transition(event, action)
+            except Exception as e:
+                print(f"Error applying event {event_id}: {e}")
+
+def parse_wake_up_times(wake_up_times):
+    """Parses comma-separated wake-up times, either hours (HH) or hours and minutes (HH:MM), into (hour, minute) pairs.
+
+    A time given more than once (e.g. "7,07:00") is kept only at its first position.
+    """
+    times = []
+    for wake_up_time in (wake_up_times or "").split(','):
+        match = re.match(r'^\s*(\d{1,2})(?::(\d{2}))?\s*$', wake_up_time)
+        if match:
+            hour, minute = int(match.group(1)), int(match.group(2) or 0)
+            if hour < 24 and minute < 60 and (hour, minute) not in times:
+                times.append((hour, minute))
+    return times
+
+def format_wake_up_times(wake_up_times):
+    """Formats wake-up times for the frames: whole hours as plain hours (e.g. "7,18"), other times as H:MM (e.g. "12:30").
+
+    Schedules of whole hours stay in the hours-only format that frame firmware without minute support reads.
+    """
+    return ",".join(str(hour) if minute == 0 else f"{hour}:{minute:02d}" for hour, minute in parse_wake_up_times(wake_up_times))
+
+def make_temp_file(path):
+    """Creates an empty file next to path and returns its name, to write a new version of path in before os.replace.
+
+    mkstemp gives every thread of every server process a name of its own, so two writers of one file never share a temp file.
+    """
+    fd, temp_path = tempfile.mkstemp(prefix='.' + os.path.basename(path) + '.', suffix='.tmp', dir=os.path.dirname(path))
+    os.close(fd)
+    # mkstemp creates the file readable by its owner only, Apache serves the static files as another user
+    os.chmod(temp_path, 0o644)
+    return temp_path
+
+def write_atomic(path, data):
+    """Writes bytes to a temporary file next to path and renames it over path, so readers never see a partly written file."""
+    temp_path = make_temp_file(path)
+    try:
+        with open(temp_path, 'wb') as file:
+            file.write(data)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+def evict_cache_entries(cache_path, max_bytes, keep_path=None):
+    """Removes the least recently used entries of a cache folder, except keep_path, until the rest fits in max_bytes.
+
+    An entry is a file or a folder of files, its modification time is when it was last used. Entries
+    still being written, under temporary names starting with '.' or 'tmp-', are left alone.
+    """
+    entries = []
+    total_size = 0
+    for name in os.listdir(cache_path):
+        entry_path = os.path.join(cache_path, name)
+        if name.startswith(('.', 'tmp-')) or entry_path == keep_path:
+            continue
+        try:
+            size = os.path.getsize(entry_path)
+            if os.path.isdir(entry_path):
+                size = sum(os.path.getsize(os.path.join(folder, filename)) for folder, _, filenames in os.walk(entry_path) for filename in filenames)
+            entries.append((os.path.getmtime(entry_path), size, entry_path))
+        except OSError:
+            continue
+        total_size += size
+
+    for _, size, entry_path in sorted(entries):
+        if total_size <= max_bytes:
+            break
+        if os.path.isdir(entry_path):
+            shutil.rmtree(entry_path, ignore_errors=True)
+        else:
+            try:
+                os.remove(entry_path)
+            except OSError:
+                pass
+        total_size -= size
 
 def write_wake_up_times_to_file(frame_id, active_wake_up_times):
     """Writes the active wake-up times to a text file named after the frame ID."""
@@ -172,43 +644,129 @@ def write_wake_up_times_to_file(frame_id, active_wake_up_times):
     # Ensure the static folder exists
     os.makedirs(STATIC_FOLDER_PATH, exist_ok=True)
     
-    # Write the active wake-up times to the file
-    with open(file_path, 'w') as file:
-        file.write(active_wake_up_times or "")
+    # Write the active wake-up times under a temporary name, so a frame never reads a partly written file
+    write_atomic(file_path, format_wake_up_times(active_wake_up_times).encode('ascii'))
 
-def pick_random_image_from_category(category, orientation):
-    # Load cached data from the JSON file
-    with open(CACHE_FILE_PATH, 'r') as cache_file:
-        folders = json.load(cache_file)
-    
-    image_paths = []
-    linked_folders = category.linked_folders.split(',')
+def get_render_queue_key(frame, screen_type):
+    """Identifies the category and screen type a frame's queued renders were made for."""
+    return f"{frame.category_id}|{screen_type.name}|{screen_type.orientation}|{screen_type.dither}|{screen_type.script_filename}"
 
-    for folder_name in linked_folders:
-        folder_name = folder_name.strip()
-        
-        # Retrieve images from the cached data
-        folder_images = folders.get(folder_name)
-        if folder_images:
-            for image_info in folder_images:
-                # Include square images for both horizontal and vertical requests
+def get_render_queue_path(frame_id_code):
+    return os.path.join(RENDER_QUEUE_PATH, frame_id_code)
+
+def invalidate_render_queue(frame_id_code):
+    """Drops the images rendered ahead of time for a frame."""
+    shutil.rmtree(get_render_queue_path(frame_id_code), ignore_errors=True)
+
+def list_render_queue(frame_id_code, key):
+    """Returns the queued render folders of a frame, oldest first. A queue made for another key is dropped."""
+    queue_path = get_render_queue_path(frame_id_code)
+    try:
+        with open(os.path.join(queue_path, 'key.txt'), 'r') as key_file:
+            queue_key = key_file.read()
+    except IOError:
+        return []
+
+    if queue_key != key:
+        invalidate_render_queue(frame_id_code)
+        return []
+
+    return [os.path.join(queue_path, name) for name in sorted(os.listdir(queue_path)) if name.startswith('item-')]
+
+def publish_queued_render(frame_id_code, key):
+    """Moves the oldest queued render of a frame into the static folder and returns the published file names."""
+    for item_path in list_render_queue(frame_id_code, key):
+        # Claim the item first, so it is never published twice
+        claimed_path = os.path.join(os.path.dirname(item_path), 'claimed-' + os.path.basename(item_path))
+        try:
+            os.rename(item_path, claimed_path)
+        except OSError:
+            continue
+
+        os.makedirs(STATIC_FOLDER_PATH, exist_ok=True)
+        published = []
+        for filename in sorted(os.listdir(claimed_path)):
+            target_path = os.path.join(STATIC_FOLDER_PATH, filename)
+            os.replace(os.path.join(claimed_path, filename), target_path)
+            os.utime(target_path)  # The modification time is when the image was published
+            published.append(filename)
+        shutil.rmtree(claimed_path, ignore_errors=True)
+        return published
+
+    return None
+
+# In-memory index of the JSON image cache, shared by the scheduler and /random_image:
+# {'mtime': cache file mtime, 'folders': {folder: {orientation: [image paths]}}, 'candidates': {(linked folders, orientation): [image paths]}}
+pick_index = None
+pick_index_lock = threading.Lock()
+
+def build_pick_index(folders, mtime):
+    """Groups the image paths of the cached folder structure per folder and orientation."""
+    folder_paths = {}
+    for folder_name, folder_images in folders.items():
+        base_path = SHARED_IMAGES_BASE if folder_name.startswith("Shared - ") else LOCAL_IMAGES_BASE
+        folder_path = os.path.join(base_path, folder_name.split(" - ", 1)[1].strip())
+        by_orientation = {}
+        for image_info in folder_images:
+            # Skip the placeholders of missing folders
+            if image_info["orientation"]:
+                by_orientation.setdefault(image_info["orientation"], []).append(os.path.join(folder_path, image_info["name"]))
+        folder_paths[folder_name] = by_orientation
+
+    return {'mtime': mtime, 'folders': folder_paths, 'candidates': {}}
+
+def update_pick_index(folders):
+    """Replaces the in-memory pick index after the JSON cache was written."""
+    global pick_index
+    with pick_index_lock:
+        pick_index = build_pick_index(folders, os.path.getmtime(CACHE_FILE_PATH))
+
+def get_pick_index():
+    """Returns the in-memory pick index, reloading it only when the JSON cache file changed."""
+    global pick_index
+    if not os.path.exists(CACHE_FILE_PATH):
+        # Nothing indexed yet, serve an empty index until the rebuild is done
+        start_index_rebuild()
+        return build_pick_index({}, None)
+
+    mtime = os.path.getmtime(CACHE_FILE_PATH)
+    index = pick_index
+    if index and index['mtime'] == mtime:
+        return index
+
+    with pick_index_lock:
+        if not pick_index or pick_index['mtime'] != mtime:
+            with open(CACHE_FILE_PATH, 'r') as cache_file:
+                pick_index = build_pick_index(json.load(cache_file), mtime)
+        return pick_index
+
+def get_image_candidates(linked_folders, orientation):
+    """Returns the image paths in the linked folders (comma-separated) for an orientation, or all of them for None.
+
+    Square images are included for both horizontal and vertical requests. Lists are built once per
+    folder set and orientation and reused until the cache changes.
+    """
+    index = get_pick_index()
+    key = (linked_folders, orientation)
+    candidates = index['candidates'].get(key)
+    if candidates is None:
+        candidates = []
+        for folder_name in linked_folders.split(','):
+            by_orientation = index['folders'].get(folder_name.strip(), {})
+            for image_orientation, image_paths in by_orientation.items():
                 if (
-                    image_info["orientation"].lower() == orientation.lower() or
-                    (orientation.lower() in ["horizontal", "vertical"] and image_info["orientation"].lower() == "square")
+                    not orientation or
+                    image_orientation == orientation or
+                    (orientation in ["Horizontal", "Vertical"] and image_orientation == "Square")
                 ):
-                    # Construct the image path
-                    image_path = os.path.join(
-                        SHARED_IMAGES_BASE if folder_name.startswith("Shared - ") else LOCAL_IMAGES_BASE,
-                        folder_name.split(" - ", 1)[1].strip(),
-                        image_info["name"]
-                    )
-                    image_paths.append(image_path)
+                    candidates.extend(image_paths)
+        index['candidates'][key] = candidates
+    return candidates
 
-    # Shuffle the list of image paths to introduce randomness
-    random.shuffle(image_paths)
-
-    # Select the first image in the shuffled list, or None if no images are found
-    return image_paths[0] if image_paths else None
+def pick_random_image_from_category(category, orientation):
+    """Returns a random image path of the category for the orientation, or None if there are no images."""
+    image_paths = get_image_candidates(category.linked_folders, orientation.capitalize())
+    return random.choice(image_paths) if image_paths else None
 
 # Helper function to validate ID code
 def is_valid_id_code(id_code):
@@ -216,8 +774,11 @@ def is_valid_id_code(id_code):
 
 @app.route('/')
 def home():
-    photo_frames = PhotoFrame.query.all()
-    return render_template('home.html', photo_frames=photo_frames)
+    photo_frames = get_config_snapshot().frames
+    now = datetime.now()
+    fetches = load_frame_fetches([frame.id_code for frame in photo_frames])
+    telemetry = {frame.id_code: get_frame_telemetry(frame, fetches[frame.id_code], now) for frame in photo_frames}
+    return render_template('home.html', photo_frames=photo_frames, telemetry=telemetry)
 
 @app.route('/add_frame', methods=['GET', 'POST'])
 def add_frame():
@@ -242,23 +803,26 @@ def add_frame():
         )
         db.session.add(new_frame)
         db.session.commit()
+        invalidate_config_snapshot()
 
         # Write active wake-up times to the file
         write_wake_up_times_to_file(id_code, active_wake_up_times)
+        rebuild_render_schedule()
         
         return redirect(url_for('home'))
     
-    screen_types = ScreenType.query.all()
-    categories = Category.query.all()
-    return render_template('add_frame.html', screen_types=screen_types, categories=categories)
+    snapshot = get_config_snapshot()
+    return render_template('add_frame.html', screen_types=snapshot.screen_types, categories=snapshot.categories)
 
 @app.route('/edit_frame/<int:id>', methods=['GET', 'POST'])
 def edit_frame(id):
     photo_frame = PhotoFrame.query.get_or_404(id)
-    screen_types = ScreenType.query.all()
-    categories = Category.query.all()
+    snapshot = get_config_snapshot()
     
     if request.method == 'POST':
+        # The category or screen type may change, so drop the queued renders
+        invalidate_render_queue(photo_frame.id_code)
+
         photo_frame.id_code = request.form['id_code']
         photo_frame.name = request.form['name']
         photo_frame.ip_address = request.form['ip_address']
@@ -268,20 +832,25 @@ def edit_frame(id):
         photo_frame.category_id = request.form.get('category_id')
 
         db.session.commit()
+        invalidate_config_snapshot()
         
         # Write active wake-up times to the file
         write_wake_up_times_to_file(photo_frame.id_code, photo_frame.active_wake_up_times)
+        rebuild_render_schedule()
         
         return redirect(url_for('home'))
 
-    return render_template('edit_frame.html', photo_frame=photo_frame, screen_types=screen_types, categories=categories)
+    return render_template('edit_frame.html', photo_frame=photo_frame, screen_types=snapshot.screen_types, categories=snapshot.categories)
 
 # Delete photo frame
 @app.route('/delete_frame/<int:id>', methods=['POST'])
 def delete_frame(id):
     photo_frame = PhotoFrame.query.get_or_404(id)
+    invalidate_render_queue(photo_frame.id_code)
     db.session.delete(photo_frame)
     db.session.commit()
+    invalidate_config_snapshot()
+    rebuild_render_schedule()
     return redirect(url_for('home'))
 
 @app.route('/settings', methods=['GET', 'POST'])
@@ -290,16 +859,35 @@ def settings():
         name = request.form['name']
         script_filename = request.form['script_filename']
         orientation = request.form['orientation']  # Get orientation from the form
+        dither = request.form.get('dither', DEFAULT_DITHER)
+        if dither not in DITHER_ALGORITHMS:
+            dither = DEFAULT_DITHER
         
         # Check if screen type with the same name already exists
         if not ScreenType.query.filter_by(name=name).first():
             # Create and add the new screen type to the database
-            new_screen_type = ScreenType(name=name, script_filename=script_filename, orientation=orientation)
+            new_screen_type = ScreenType(name=name, script_filename=script_filename, orientation=orientation, dither=dither)
             db.session.add(new_screen_type)
             db.session.commit()
+            invalidate_config_snapshot()
     
-    screen_types = ScreenType.query.all()
-    return render_template('settings.html', screen_types=screen_types)
+    return render_template('settings.html', screen_types=get_config_snapshot().screen_types, dither_algorithms=DITHER_ALGORITHMS)
+
+@app.route('/screen_type_dither/<string:name>', methods=['POST'])
+def set_screen_type_dither(name):
+    screen_type = ScreenType.query.filter_by(name=name).first()
+    dither = request.form.get('dither')
+    if screen_type and dither in DITHER_ALGORITHMS:
+        screen_type.dither = dither
+        db.session.commit()
+        invalidate_config_snapshot()
+
+        # Queued renders were made with the previous algorithm
+        for frame in get_config_snapshot().frames:
+            if frame.screen_type == name:
+                invalidate_render_queue(frame.id_code)
+
+    return redirect(url_for('settings'))
 
 @app.route('/delete_screen_type/<string:name>', methods=['POST'])
 def delete_screen_type(name):
@@ -307,19 +895,18 @@ def delete_screen_type(name):
     if screen_type:
         db.session.delete(screen_type)
         db.session.commit()
+        invalidate_config_snapshot()
     
     return redirect(url_for('settings'))
 
 @app.route('/events')
 def events():
-    # Fetch all events from the database
-    events = Event.query.all()
-    return render_template('events.html', events=events)
+    # Fetch all events with their categories and frames
+    return render_template('events.html', events=get_config_snapshot().events)
 
 @app.route('/add_event', methods=['GET', 'POST'])
 def add_event():
-    categories = Category.query.all()
-    frames = PhotoFrame.query.all()  # Fetch all frames for selection
+    snapshot = get_config_snapshot()
     
     if request.method == 'POST':
         name = request.form['name']  # Capture the name field
@@ -348,17 +935,18 @@ def add_event():
         new_event.frames = PhotoFrame.query.filter(PhotoFrame.id.in_(selected_frame_ids)).all()
         db.session.add(new_event)
         db.session.commit()
+        invalidate_config_snapshot()
+        rebuild_event_queue()
 
         flash('New event added successfully!')
         return redirect(url_for('events'))
 
-    return render_template('add_event.html', categories=categories, frames=frames)
+    return render_template('add_event.html', categories=snapshot.categories, frames=snapshot.frames)  # All frames for selection
 
 @app.route('/edit_event/<int:id>', methods=['GET', 'POST'])
 def edit_event(id):
     event = Event.query.get_or_404(id)
-    categories = Category.query.all()
-    frames = PhotoFrame.query.all()
+    snapshot = get_config_snapshot()
     
     if request.method == 'POST':
         # Form data
@@ -377,108 +965,432 @@ def edit_event(id):
         event.end_day_month = f"{end_month}-{end_day}" if end_month and end_day else None
         event.event_times = event_times
         event.category_id = category_id
+        event.updated_at = datetime.now()  # The edited event's transitions are applied again
 
         # Update linked frames
         event.frames = PhotoFrame.query.filter(PhotoFrame.id.in_(selected_frame_ids)).all()
         db.session.commit()
+        invalidate_config_snapshot()
+        rebuild_event_queue()
         
         flash('Event updated successfully!')
         return redirect(url_for('events'))
 
     # Pre-select frames linked to this event
     selected_frame_ids = [frame.id for frame in event.frames]
-    return render_template('edit_event.html', event=event, categories=categories, frames=frames, selected_frame_ids=selected_frame_ids)
+    return render_template('edit_event.html', event=event, categories=snapshot.categories, frames=snapshot.frames, selected_frame_ids=selected_frame_ids)
 
 @app.route('/delete_event/<int:id>', methods=['POST'])
 def delete_event(id):
     event = Event.query.get_or_404(id)
     db.session.delete(event)
     db.session.commit()
+    invalidate_config_snapshot()
+    rebuild_event_queue()
     flash('Event deleted successfully!')
     return redirect(url_for('events'))
 
-def index_folders():
-    """Scans both shared and local folders and saves the structure to cache with orientation data."""
-    folders = {}
-
-    # Helper function to determine orientation
-    def determine_orientation(image_path):
-        with Image.open(image_path) as img:
-            width, height = img.size
-            if width > height:
-                return "Horizontal"
-            elif height > width:
-                return "Vertical"
+def determine_orientation(width, height):
+    """Returns the orientation name for image dimensions."""
+    if width > height:
+        return "Horizontal"
+    elif height > width:
+        return "Vertical"
+    else:
+        return "Square"
+
+def read_exif_orientation(segment):
+    """Returns the EXIF orientation tag of a JPEG APP1 segment, or 1 if it has none."""
+    if segment[:6] != b'Exif\x00\x00':
+        return 1
+    tiff = segment[6:]
+    endian = {b'II': '<', b'MM': '>'}.get(tiff[:2])
+    if not endian:
+        return 1
+
+    # Walk the entries of the first image file directory
+    ifd_offset = struct.unpack(endian + 'I', tiff[4:8])[0]
+    entry_count = struct.unpack(endian + 'H', tiff[ifd_offset:ifd_offset + 2])[0]
+    for i in range(entry_count):
+        entry = tiff[ifd_offset + 2 + i * 12:ifd_offset + 14 + i * 12]
+        if len(entry) < 12:
+            break
+        if struct.unpack(endian + 'H', entry[:2])[0] == 0x0112:
+            return struct.unpack(endian + 'H', entry[8:10])[0]
+    return 1
+
+def read_image_size(image_path):
+    """Reads the displayed width and height of a JPEG, PNG or GIF from its header, or None if it can't be parsed.
+
+    JPEG segments are skipped with seeks up to the frame header, so only a few KB of the file are read
+    however large it is. EXIF orientations that turn the image by 90 degrees swap width and height.
+    """
+    with open(image_path, 'rb') as image_file:
+        head = image_file.read(24)
+        if head[:8] == b'\x89PNG\r\n\x1a\n' and head[12:16] == b'IHDR':
+            return struct.unpack('>II', head[16:24])
+        if head[:6] in (b'GIF87a', b'GIF89a'):
+            return struct.unpack('<HH', head[6:10])
+        if head[:2] != b'\xff\xd8':
+            return None
+
+        image_file.seek(2)
+        rotated = False
+        while True:
+            if image_file.read(1) != b'\xff':
+                return None
+            marker = image_file.read(1)
+            while marker == b'\xff':  # Fill bytes
+                marker = image_file.read(1)
+            if not marker:
+                return None
+            marker = marker[0]
+            if marker == 0x01 or 0xD0 <= marker <= 0xD8:  # Markers without a length
+                continue
+            if marker in (0xD9, 0xDA):  # End of image or start of scan before a frame header
+                return None
+
+            length = struct.unpack('>H', image_file.read(2))[0]
+            if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                # Start of frame: precision, height, width
+                height, width = struct.unpack('>HH', image_file.read(5)[1:5])
+                return (height, width) if rotated else (width, height)
+            if marker == 0xE1:
+                # EXIF, the orientation is in the first image file directory near the start
+                segment = image_file.read(min(length - 2, 4096))
+                rotated = rotated or read_exif_orientation(segment) in (5, 6, 7, 8)
+                image_file.seek(length - 2 - len(segment), 1)
             else:
-                return "Square"
+                image_file.seek(length - 2, 1)
+
+def probe_image_size(image_path):
+    """Returns the displayed width and height of an image, falling back to PIL for files the header parser doesn't handle."""
+    try:
+        size = read_image_size(image_path)
+    except (struct.error, IndexError):
+        size = None
+    if size:
+        return size
+
+    with Image.open(image_path) as img:
+        width, height = img.size
+        if img.getexif().get(0x0112) in (5, 6, 7, 8):
+            return height, width
+        return width, height
+
+def probe_image(image_path, known):
+    """Stats an image and returns (stat, (width, height)), the size is None when known (size, mtime) still matches."""
+    stat = os.stat(image_path)
+    if known == (stat.st_size, stat.st_mtime_ns):
+        return stat, None
+    return stat, probe_image_size(image_path)
+
+def list_image_folders(base_path, prefix, image_folders):
+    """Appends (folder key, folder path, image filenames) for every folder in base_path to image_folders."""
+    for folder_name in os.listdir(base_path):
+        folder_path = os.path.join(base_path, folder_name)
+        
+        if os.path.isdir(folder_path):
+            filenames = [filename for filename in os.listdir(folder_path) if filename.lower().endswith(('.png', '.jpg', '.jpeg', '.gif'))]
+            image_folders.append((f"{prefix} - {folder_name}", folder_path, filenames))
+
+def apply_index_changes(changed_rows, removed_paths):
+    """Saves new and changed images (rows of IndexedImage columns) and drops removed paths from the image index.
+
+    The changes are staged a batch per transaction, so requests and the scheduler can write in between,
+    and then applied in one short transaction: readers see either the previous index or the new one.
+    """
+    run_id = time.time_ns()
+    staging = indexed_image_staging.c
+
+    # Drop the staged changes of runs that never finished
+    db.session.execute(db.delete(indexed_image_staging).where(staging.run_id < run_id - INDEX_STAGING_MAX_AGE * 10**9))
+    db.session.commit()
+
+    staged_rows = [{'run_id': run_id, 'removed': False, **row} for row in changed_rows]
+    empty_row = dict.fromkeys(('folder', 'name', 'size', 'mtime', 'width', 'height', 'orientation'))
+    staged_rows += [{'run_id': run_id, 'removed': True, 'path': path, **empty_row} for path in removed_paths]
+    for start in range(0, len(staged_rows), INDEX_WRITE_BATCH):
+        db.session.execute(db.insert(indexed_image_staging), staged_rows[start:start + INDEX_WRITE_BATCH])
+        db.session.commit()
 
-    # Index images in the shared folder if it exists
+    columns = ('path', 'folder', 'name', 'size', 'mtime', 'width', 'height', 'orientation')
+    changed = db.select(*(staging[name] for name in columns)).where(staging.run_id == run_id, staging.removed == False)
+    upsert = sqlite_insert(IndexedImage).from_select(columns, changed)
+    upsert = upsert.on_conflict_do_update(
+        index_elements=[IndexedImage.path],
+        set_={name: upsert.excluded[name] for name in columns[1:]}
+    )
+    removed = db.select(staging.path).where(staging.run_id == run_id, staging.removed == True)
+    db.session.execute(upsert)
+    db.session.execute(db.delete(IndexedImage).where(IndexedImage.path.in_(removed)))
+    db.session.execute(db.delete(indexed_image_staging).where(staging.run_id == run_id))
+    db.session.commit()
+
+def index_folders():
+    """Scans both shared and local folders and saves the structure to cache with orientation data.
+
+    Dimensions are kept in the IndexedImage table, so only new or changed files are probed and
+    files that disappeared are dropped from it. Files are probed concurrently, reading only their
+    headers, so a network share is not scanned one round-trip at a time.
+    """
+    start_time = time.perf_counter()
+    folders = {}
+    image_folders = []
+    indexed = {row.path: row for row in db.session.execute(db.select(IndexedImage.path, IndexedImage.size, IndexedImage.mtime, IndexedImage.orientation))}
+    db.session.close()  # Return the connection to the pool while the files are probed
+    changed_rows = []
+    seen_paths = set()
+    scanned_roots = []
+    counts = {'indexed': 0, 'probed': 0, 'failed': 0, 'removed': 0}
+
+    # List the images in the shared folder if it exists
     if os.path.exists(SHARED_IMAGES_PATH):
-        for folder_name in os.listdir(SHARED_IMAGES_PATH):
-            folder_path = os.path.join(SHARED_IMAGES_PATH, folder_name)
-            
-            if os.path.isdir(folder_path):
-                images = []
-                for filename in os.listdir(folder_path):
-                    if filename.lower().endswith(('.png', '.jpg', '.jpeg', '.gif')):
-                        image_path = os.path.join(folder_path, filename)
-                        orientation = determine_orientation(image_path)  # Get orientation
-                        images.append({
-                            "name": filename,
-                            "orientation": orientation
-                        })
-                folders[f"Shared - {folder_name}"] = images
+        scanned_roots.append(SHARED_IMAGES_PATH)
+        list_image_folders(SHARED_IMAGES_PATH, "Shared", image_folders)
     else:
         folders["Shared - Folder Missing"] = [{"name": "No shared images folder is mounted.", "orientation": None}]
 
-    # Index images in the local folder if it exists
+    # List the images in the local folder if it exists
     if os.path.exists(LOCAL_IMAGES_PATH):
-        for folder_name in os.listdir(LOCAL_IMAGES_PATH):
-            folder_path = os.path.join(LOCAL_IMAGES_PATH, folder_name)
-            
-            if os.path.isdir(folder_path):
-                images = []
-                for filename in os.listdir(folder_path):
-                    if filename.lower().endswith(('.png', '.jpg', '.jpeg', '.gif')):
-                        image_path = os.path.join(folder_path, filename)
-                        orientation = determine_orientation(image_path)  # Get orientation
-                        images.append({
-                            "name": filename,
-                            "orientation": orientation
-                        })
-                folders[f"Local - {folder_name}"] = images
+        scanned_roots.append(LOCAL_IMAGES_PATH)
+        list_image_folders(LOCAL_IMAGES_PATH, "Local", image_folders)
     else:
         folders["Local - Folder Missing"] = [{"name": "No local images folder found.", "orientation": None}]
 
-    # Save the indexed structure to a JSON cache file
-    with open(CACHE_FILE_PATH, 'w') as cache_file:
-        json.dump(folders, cache_file)
+    with ThreadPoolExecutor(max_workers=INDEX_WORKERS, thread_name_prefix='index') as executor:
+        # Probe all files up front, the results are applied to the index in listing order
+        probes = []
+        for folder_key, folder_path, filenames in image_folders:
+            for filename in filenames:
+                image_path = os.path.join(folder_path, filename)
+                entry = indexed.get(image_path)
+                known = (entry.size, entry.mtime) if entry else None
+                probes.append((folder_key, filename, image_path, executor.submit(probe_image, image_path, known)))
+
+        for folder_key, folder_path, filenames in image_folders:
+            folders[folder_key] = []
+        index_status['total'] = len(probes)
+
+        for folder_key, filename, image_path, future in probes:
+            try:
+                stat, size = future.result()
+            except Exception as e:
+                print(f"Error indexing {image_path}: {e}")
+                counts['failed'] += 1
+                continue
+            finally:
+                index_status['scanned'] += 1
+            seen_paths.add(image_path)
+
+            counts['indexed'] += 1
+            if size:
+                # New or changed file
+                counts['probed'] += 1
+                orientation = determine_orientation(*size)
+                changed_rows.append({
+                    'path': image_path,
+                    'folder': folder_key,
+                    'name': filename,
+                    'size': stat.st_size,
+                    'mtime': stat.st_mtime_ns,
+                    'width': size[0],
+                    'height': size[1],
+                    'orientation': orientation
+                })
+            else:
+                orientation = indexed[image_path].orientation
+
+            folders[folder_key].append({
+                "name": filename,
+                "orientation": orientation
+            })
+
+    # Drop files that were deleted, entries of an unmounted share are kept for when it comes back
+    removed_paths = [path for path in indexed if path not in seen_paths and any(path.startswith(root + os.sep) for root in scanned_roots)]
+    counts['removed'] = len(removed_paths)
+
+    apply_index_changes(changed_rows, removed_paths)
+
+    # Save the indexed structure to a JSON cache file, replacing the previous one in one step
+    write_atomic(CACHE_FILE_PATH, json.dumps(folders).encode('utf-8'))
+    update_pick_index(folders)
+
+    duration = time.perf_counter() - start_time
+    observe_metric('imageserver_index_scan_seconds', duration)
+    for result, count in counts.items():
+        set_metric('imageserver_index_files', count, (result,))
+    log_record('index_scan', seconds=round(duration, 3), files=counts)
     return folders
 
+# Progress of the background index rebuild, reported by /index_status
+index_status = {'running': False, 'scanned': 0, 'total': 0, 'started': None, 'finished': None, 'error': None}
+index_status_lock = threading.Lock()
+
+def run_index_rebuild():
+    """Runs index_folders and records when it finished."""
+    with app.app_context():
+        try:
+            index_folders()
+        except Exception as e:
+            index_status['error'] = str(e)
+            print(f"Error indexing images: {e}")
+        finally:
+            with index_status_lock:
+                index_status['running'] = False
+                index_status['finished'] = time.time()
+
+def start_index_rebuild():
+    """Starts rebuilding the image index in a background thread, unless a rebuild is already running."""
+    with index_status_lock:
+        if index_status['running']:
+            return False
+        index_status.update(running=True, scanned=0, total=0, started=time.time(), finished=None, error=None)
+
+    rebuild_thread = threading.Thread(target=run_index_rebuild)
+    rebuild_thread.daemon = True
+    rebuild_thread.start()
+    return True
+
+def is_cache_valid():
+    """Checks if the JSON cache file exists and is younger than CACHE_DURATION."""
+    return os.path.exists(CACHE_FILE_PATH) and time.time() - os.path.getmtime(CACHE_FILE_PATH) < CACHE_DURATION
+
+def start_index_rebuild_if_needed():
+    """Re-indexes in the background if the cache expired, or if the index table is empty (e.g. right after an upgrade)."""
+    if not is_cache_valid() or IndexedImage.query.first() is None:
+        start_index_rebuild()
+
 def load_cached_folders():
-    """Loads the cached folder structure if it's still valid, otherwise re-indexes."""
-    if os.path.exists(CACHE_FILE_PATH):
-        cache_age = time.time() - os.path.getmtime(CACHE_FILE_PATH)
-        if cache_age < CACHE_DURATION:
-            try:
-                with open(CACHE_FILE_PATH, 'r') as cache_file:
-                    return json.load(cache_file)
-            except (json.JSONDecodeError, IOError):
-                pass
+    """Loads the cached folder structure. An expired or missing cache is rebuilt in the background while the previous one is served."""
+    if not is_cache_valid():
+        start_index_rebuild()
 
-    return index_folders()
+    try:
+        with open(CACHE_FILE_PATH, 'r') as cache_file:
+            return json.load(cache_file)
+    except (json.JSONDecodeError, IOError):
+        return {}
 
 @app.route('/images')
 def images():
-    folders = load_cached_folders()
-    return render_template('images.html', folders=folders)
+    """Lists the folders with their image counts, the images themselves are loaded page by page from /api/images."""
+    start_index_rebuild_if_needed()
+
+    folders = db.session.query(IndexedImage.folder, db.func.count(IndexedImage.id)).group_by(IndexedImage.folder).order_by(IndexedImage.folder).all()
+    return render_template('images.html', folders=folders, indexing=index_status['running'], thumbnail_size=THUMBNAIL_SIZE)
+
+@app.route('/api/images')
+def list_images():
+    """Returns a page of the image index as JSON, optionally filtered by folder and orientation.
+
+    Query parameters: folder (e.g. "Local - default"), orientation (horizontal, vertical or square),
+    page (from 1) and per_page (up to IMAGES_PAGE_SIZE_MAX).
+    """
+    start_index_rebuild_if_needed()
+    query = IndexedImage.query
+    folder = request.args.get('folder')
+    if folder:
+        query = query.filter(IndexedImage.folder == folder)
+    orientation = request.args.get('orientation')
+    if orientation:
+        query = query.filter(IndexedImage.orientation == orientation.capitalize())
+
+    page = query.order_by(IndexedImage.folder, IndexedImage.name).paginate(
+        page=request.args.get('page', 1, type=int),
+        per_page=request.args.get('per_page', IMAGES_PAGE_SIZE, type=int),
+        max_per_page=IMAGES_PAGE_SIZE_MAX,
+        error_out=False
+    )
+    return jsonify({
+        'images': [{
+            'id': entry.id,
+            'folder': entry.folder,
+            'name': entry.name,
+            'width': entry.width,
+            'height': entry.height,
+            'orientation': entry.orientation,
+            'thumbnail': url_for('thumbnail', image_id=entry.id, v=entry.mtime)
+        } for entry in page.items],
+        'page': page.page,
+        'per_page': page.per_page,
+        'pages': page.pages,
+        'total': page.total
+    })
+
+def get_thumbnail_path(entry):
+    """Returns where the thumbnail of an indexed image is cached; a changed file gets a new thumbnail."""
+    key = hashlib.sha256(f"{entry.path}|{entry.mtime}|{entry.size}|{THUMBNAIL_SIZE}".encode('utf-8')).hexdigest()
+    return os.path.join(THUMBNAIL_CACHE_PATH, key + '.jpg')
+
+def make_image_variant(image_path, variant_path, width, height, image_format='JPEG'):
+    """Writes an upright copy of an image that fits in width x height (None for no limit), never enlarged.
+
+    JPEGs are decoded at the smallest 1/2, 1/4 or 1/8 scale that still covers the size.
+    """
+    with Image.open(image_path) as image:
+        # The size is upright, the decoder works before EXIF rotations that swap width and height
+        rotated = image.getexif().get(0x0112) in (5, 6, 7, 8)
+        upright_width, upright_height = (image.height, image.width) if rotated else image.size
+
+        # A missing dimension follows from the aspect ratio, so the decoder can scale down for one given dimension
+        if width and not height:
+            height = math.ceil(width * upright_height / upright_width)
+        elif height and not width:
+            width = math.ceil(height * upright_width / upright_height)
+        size = (width or upright_width, height or upright_height)
+        image.draft('RGB', size[::-1] if rotated else size)
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail(size)
+        has_alpha = image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info
+        image = image.convert('RGBA' if has_alpha and image_format != 'JPEG' else 'RGB')
+
+    # Write it under a temporary name, so a half-written file is never served
+    os.makedirs(os.path.dirname(variant_path), exist_ok=True)
+    temp_path = make_temp_file(variant_path)
+    try:
+        image.save(temp_path, image_format, quality=80)
+        os.replace(temp_path, variant_path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+@app.route('/thumbnail/<int:image_id>')
+def thumbnail(image_id):
+    """Serves the thumbnail of an indexed image, generating it the first time it is asked for."""
+    entry = IndexedImage.query.get_or_404(image_id)
+    thumbnail_path = get_thumbnail_path(entry)
+    try:
+        os.utime(thumbnail_path)  # Mark as recently used
+    except FileNotFoundError:
+        try:
+            make_image_variant(entry.path, thumbnail_path, THUMBNAIL_SIZE, THUMBNAIL_SIZE)
+        except Exception as e:
+            return f"No thumbnail for {entry.name}: {e}", 404
+        evict_cache_entries(THUMBNAIL_CACHE_PATH, THUMBNAIL_CACHE_MAX_BYTES, keep_path=thumbnail_path)
+
+    # The ETag is the thumbnail's key, which stays the same when it is marked as used
+    return send_file(thumbnail_path, mimetype='image/jpeg', etag=os.path.splitext(os.path.basename(thumbnail_path))[0], max_age=THUMBNAIL_MAX_AGE, conditional=True)
 
 @app.route('/refresh_images')
 def refresh_images():
     """Route to manually refresh the image cache."""
-    index_folders()  # Refresh the cache
+    start_index_rebuild()  # Refresh the cache in the background
     return redirect(url_for('images'))  # Redirect back to the images page
 
+@app.route('/index_status')
+def get_index_status():
+    """Reports the progress of the image index rebuild."""
+    started = index_status['started']
+    end = index_status['finished'] if not index_status['running'] else time.time()
+    return jsonify({
+        'running': index_status['running'],
+        'files_scanned': index_status['scanned'],
+        'files_remaining': max(index_status['total'] - index_status['scanned'], 0),
+        'elapsed_seconds': round(end - started, 1) if started else None,
+        'error': index_status['error']
+    })
+
 @app.route('/categories', methods=['GET', 'POST'])
 def categories():
     # Fetch indexed folders from the images page cache
@@ -505,31 +1417,30 @@ def categories():
         new_category = Category(name=name, linked_folders=linked_folders_str)
         db.session.add(new_category)
         db.session.commit()
+        invalidate_config_snapshot()
 
         flash('New category added successfully!')
         return redirect(url_for('categories'))
 
     # Retrieve all categories for display
-    categories = Category.query.all()
-    return render_template('categories.html', categories=categories, folders=folders)
+    return render_template('categories.html', categories=get_config_snapshot().categories, folders=folders)
 
 @app.route('/delete_category/<int:id>', methods=['POST'])
 def delete_category(id):
     category = Category.query.get_or_404(id)
     db.session.delete(category)
     db.session.commit()
+    invalidate_config_snapshot()
     flash('Category deleted successfully!')
     return redirect(url_for('categories'))
 
 @app.route('/external_events')
 def external_events():
-    external_events = ExternalEvent.query.all()
-    return render_template('external_events.html', external_events=external_events)
+    return render_template('external_events.html', external_events=get_config_snapshot().external_events)
 
 @app.route('/add_external_event', methods=['GET', 'POST'])
 def add_external_event():
-    categories = Category.query.all()
-    frames = PhotoFrame.query.all()
+    snapshot = get_config_snapshot()
     
     if request.method == 'POST':
         name = request.form['name']  # Capture the name field
@@ -548,17 +1459,17 @@ def add_external_event():
         new_external_event.frames = PhotoFrame.query.filter(PhotoFrame.id.in_(selected_frame_ids)).all()
         db.session.add(new_external_event)
         db.session.commit()
+        invalidate_config_snapshot()
 
         flash('New external event added successfully!')
         return redirect(url_for('external_events'))
 
-    return render_template('add_external_event.html', categories=categories, frames=frames)
+    return render_template('add_external_event.html', categories=snapshot.categories, frames=snapshot.frames)
 
 @app.route('/edit_external_event/<int:id>', methods=['GET', 'POST'])
 def edit_external_event(id):
     external_event = ExternalEvent.query.get_or_404(id)
-    categories = Category.query.all()
-    frames = PhotoFrame.query.all()
+    snapshot = get_config_snapshot()
     
     if request.method == 'POST':
         name = request.form['name']
@@ -574,17 +1485,19 @@ def edit_external_event(id):
         external_event.frames = PhotoFrame.query.filter(PhotoFrame.id.in_(selected_frame_ids)).all()
         
         db.session.commit()
+        invalidate_config_snapshot()
         flash('External event updated successfully!')
         return redirect(url_for('external_events'))
 
     selected_frame_ids = [frame.id for frame in external_event.frames]
-    return render_template('edit_external_event.html', external_event=external_event, categories=categories, frames=frames, selected_frame_ids=selected_frame_ids)
+    return render_template('edit_external_event.html', external_event=external_event, categories=snapshot.categories, frames=snapshot.frames, selected_frame_ids=selected_frame_ids)
 
 @app.route('/delete_external_event/<int:id>', methods=['POST'])
 def delete_external_event(id):
     external_event = ExternalEvent.query.get_or_404(id)
     db.session.delete(external_event)
     db.session.commit()
+    invalidate_config_snapshot()
     flash('External event deleted successfully!')
     return redirect(url_for('external_events'))
 
@@ -594,8 +1507,9 @@ def random_image(category_id, orientation):
     # Retrieve the category from the database
     category = Category.query.get_or_404(category_id)
     
-    # Load cached folders and images data
-    folders = load_cached_folders()
+    # Re-index in the background if the cache expired, the pick index follows the cache file
+    if not is_cache_valid():
+        start_index_rebuild()
 
     # Define orientation mappings
     orientation_map = {
@@ -606,47 +1520,361 @@ def random_image(category_id, orientation):
     orientation_filter = orientation_map.get(orientation)
 
     # Gather image paths based on category folders and orientation
-    image_paths = []
-    for folder_name in category.linked_folders.split(','):
-        folder_name = folder_name.strip()
-        
-        # Retrieve images from the cached data
-        folder_images = folders.get(folder_name)
-        if folder_images:
-            for image_info in folder_images:
-                # Include square images for both horizontal and vertical requests
-                if (
-                    not orientation_filter or 
-                    image_info["orientation"] == orientation_filter or 
-                    (orientation_filter in ['Horizontal', 'Vertical'] and image_info["orientation"] == "Square")
-                ):
-                    # Construct the image path
-                    image_path = os.path.join(
-                        SHARED_IMAGES_BASE if folder_name.startswith("Shared - ") else LOCAL_IMAGES_BASE,
-                        folder_name.split(" - ", 1)[1].strip(),
-                        image_info["name"]
-                    )
-                    image_paths.append(image_path)
+    image_paths = get_image_candidates(category.linked_folders, orientation_filter)
+
+    # Optional size limits and format of a resized copy, instead of the original file
+    width = request.args.get('width', type=int)
+    height = request.args.get('height', type=int)
+    image_format = request.args.get('format', '').lower()
+    if any(size is not None and not 0 < size <= IMAGE_VARIANT_MAX_SIZE for size in (width, height)):
+        return f"Width and height must be between 1 and {IMAGE_VARIANT_MAX_SIZE}.", 400
+    if image_format and image_format not in IMAGE_VARIANT_FORMATS:
+        return f"Format must be one of {', '.join(IMAGE_VARIANT_FORMATS)}.", 400
 
     # Choose a random image path if any images were found
-    if image_paths:
-        chosen_image = random.choice(image_paths)
-        return send_from_directory(directory=os.path.dirname(chosen_image), path=os.path.basename(chosen_image))
-    else:
+    if not image_paths:
         return "No images available for this category and orientation.", 404
+    chosen_image = random.choice(image_paths)
+    if width is None and height is None and not image_format:
+        return send_from_directory(directory=os.path.dirname(chosen_image), path=os.path.basename(chosen_image))
+
+    try:
+        variant_path, mimetype = get_image_variant(chosen_image, width, height, image_format or 'jpeg')
+    except FileNotFoundError:
+        return f"{os.path.basename(chosen_image)} was removed, refresh the images.", 404
+    except Exception as e:
+        return f"Could not resize {os.path.basename(chosen_image)}: {e}", 500
+    return send_file(variant_path, mimetype=mimetype)
+
+def get_image_variant(image_path, width, height, image_format):
+    """Returns the path and mimetype of a resized copy of an image, made on the first request and then served from the variant cache."""
+    pil_format, extension, mimetype = IMAGE_VARIANT_FORMATS[image_format]
+    image_stat = os.stat(image_path)
+    key = f"{image_path}|{image_stat.st_mtime_ns}|{image_stat.st_size}|{width}|{height}"
+    variant_path = os.path.join(IMAGE_VARIANT_CACHE_PATH, hashlib.sha256(key.encode('utf-8')).hexdigest() + extension)
+
+    try:
+        os.utime(variant_path)  # Mark as recently used
+    except FileNotFoundError:
+        make_image_variant(image_path, variant_path, width, height, pil_format)
+        evict_cache_entries(IMAGE_VARIANT_CACHE_PATH, IMAGE_VARIANT_CACHE_MAX_BYTES, keep_path=variant_path)
+    return variant_path, mimetype
 
 def get_script_path(screen_type_name):
     # Define the path to the pyscripts folder relative to the current file
     pyscripts_folder = os.path.join(os.path.dirname(__file__), 'pyscripts')
     
-    # Retrieve the screen type entry from the database
-    screen_type = ScreenType.query.filter_by(name=screen_type_name).first()
+    # Retrieve the screen type entry from the configuration snapshot
+    screen_type = get_config_snapshot().screen_types_by_name.get(screen_type_name)
     if screen_type:
         # Join the pyscripts folder path with the script filename
         return os.path.join(pyscripts_folder, screen_type.script_filename)
     
     return None
 
+# Encoded copies of frame payloads written next to them: (content encoding, file extension, compress function)
+PAYLOAD_ENCODINGS = [
+    ('gzip', '.gz', lambda data: gzip.compress(data, mtime=0)),
+    ('deflate', '.deflate', zlib.compress)
+]
+
+def precompress_frame_files(folder, filenames):
+    """Writes gzip and deflate encoded copies of the payload files, so they are compressed once per render instead of per request."""
+    for filename in filenames:
+        if not filename.endswith(('.h', '.bin')):
+            continue
+        with open(os.path.join(folder, filename), 'rb') as payload_file:
+            data = payload_file.read()
+        for _, extension, compress in PAYLOAD_ENCODINGS:
+            write_atomic(os.path.join(folder, filename + extension), compress(data))
+
+def get_render_cache_key(screen_type_name, script_path, orientation, dither, image_path):
+    """Hashes the source image (path, mtime and size), screen type, orientation, dither algorithm and script contents."""
+    try:
+        image_stat = os.stat(image_path)
+        with open(script_path, 'rb') as script_file:
+            script_hash = hashlib.sha256(script_file.read()).hexdigest()
+    except OSError:
+        return None
+
+    key = f"{image_path}|{image_stat.st_mtime_ns}|{image_stat.st_size}|{screen_type_name}|{orientation}|{dither}|{script_hash}"
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+def publish_cached_render(cache_key, base_path):
+    """Copies a cached render to base_path plus each payload extension and returns the file names, or None on a miss."""
+    entry_path = os.path.join(RENDER_CACHE_PATH, cache_key)
+    try:
+        filenames = os.listdir(entry_path)
+        os.utime(entry_path)  # Mark as recently used
+    except OSError:
+        return None
+
+    published = []
+    for filename in sorted(filenames):
+        target_path = base_path + os.path.splitext(filename)[1]
+        temp_path = make_temp_file(target_path)
+        try:
+            shutil.copyfile(os.path.join(entry_path, filename), temp_path)
+            os.replace(temp_path, target_path)
+        except OSError:
+            # Evicted while copying, render it again instead
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return None
+        published.append(os.path.basename(target_path))
+
+    precompress_frame_files(os.path.dirname(base_path), published)
+    return published
+
+def store_cached_render(cache_key, rendered_path):
+    """Copies the payload files in rendered_path into the render cache and evicts the least recently used entries."""
+    os.makedirs(RENDER_CACHE_PATH, exist_ok=True)
+    temp_path = tempfile.mkdtemp(prefix='tmp-', dir=RENDER_CACHE_PATH)
+    try:
+        for filename in os.listdir(rendered_path):
+            shutil.copyfile(os.path.join(rendered_path, filename), os.path.join(temp_path, 'payload' + os.path.splitext(filename)[1]))
+        os.rename(temp_path, os.path.join(RENDER_CACHE_PATH, cache_key))
+    except OSError:
+        # Another render stored the same entry first
+        shutil.rmtree(temp_path, ignore_errors=True)
+        return
+
+    evict_cache_entries(RENDER_CACHE_PATH, RENDER_CACHE_MAX_BYTES)
+
+# Recently measured render durations in seconds per screen type name, used for the render lead time
+render_durations = {}
+
+def record_render_duration(screen_type_name, duration):
+    """Keeps the duration of a finished render for the screen type."""
+    render_durations.setdefault(screen_type_name, deque(maxlen=RENDER_DURATION_SAMPLES)).append(duration)
+
+def record_render_failure(frame_id_code, screen_type_name, error):
+    """Counts a failed render of the frame and logs why it failed."""
+    inc_metric('imageserver_render_failures_total', (frame_id_code,))
+    log_record('render_failed', frame=frame_id_code, screen_type=screen_type_name, error=error)
+
+def get_render_lead_time(screen_type_name):
+    """Returns how many seconds before a wake-up time a frame of the screen type should be rendered."""
+    durations = render_durations.get(screen_type_name)
+    if not durations:
+        return RENDER_LEAD_DEFAULT
+    return max(durations) * RENDER_LEAD_FACTOR + RENDER_LEAD_MARGIN
+
+# Renders scheduled by schedule_task as a heap of (render time, wake-up time, frame id, screen type name)
+render_schedule = []
+render_schedule_dirty = True
+render_schedule_condition = threading.Condition()
+# Renders already started as {(frame id, wake-up time): render time}, so a rebuilt schedule does not render them again
+dispatched_renders = {}
+
+# Long-lived worker pool that renders due frames in parallel, each render runs in a worker process
+render_executor = ThreadPoolExecutor(max_workers=RENDER_WORKERS, thread_name_prefix='render')
+
+# Worker processes that load screen-type scripts once and render with their render() entry point
+RENDER_WORKER_PATH = os.path.join(os.path.dirname(__file__), 'render_worker.py')
+# Idle render worker processes, a render takes one and puts it back when it is done
+idle_render_workers = []
+render_workers_lock = threading.Lock()
+
+def stop_render_worker(worker):
+    """Kills a render worker process and closes its pipes."""
+    worker.kill()
+    worker.wait()
+    worker.stdin.close()
+    worker.stdout.close()
+
+def run_in_render_worker(script_path, image_path, orientation, dither):
+    """Renders an image in an idle render worker process and returns its (status, result, timings) reply.
+
+    A worker that does not reply within RENDER_TIMEOUT is killed and TimeoutError raised, the next
+    render starts a new worker in its place.
+    """
+    with render_workers_lock:
+        worker = idle_render_workers.pop() if idle_render_workers else None
+    if worker and worker.poll() is not None:
+        stop_render_worker(worker)
+        worker = None
+    if worker is None:
+        worker = subprocess.Popen(["python3", RENDER_WORKER_PATH], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    try:
+        pickle.dump((script_path, image_path, orientation, dither), worker.stdin, protocol=pickle.HIGHEST_PROTOCOL)
+        worker.stdin.flush()
+        readable, _, _ = select.select([worker.stdout], [], [], RENDER_TIMEOUT)
+        if not readable:
+            raise TimeoutError(f"render killed after {RENDER_TIMEOUT} seconds")
+        reply = pickle.load(worker.stdout)
+    except BaseException:
+        stop_render_worker(worker)
+        raise
+
+    with render_workers_lock:
+        idle_render_workers.append(worker)
+    return reply
+
+def write_render_payloads(payloads, frame_output_name):
+    """Writes the payload files of a render next to frame_output_name and returns their names."""
+    # Ensure the output folder exists
+    os.makedirs(os.path.dirname(frame_output_name), exist_ok=True)
+
+    base_path = os.path.splitext(frame_output_name)[0]
+    for extension, payload in payloads.items():
+        with open(base_path + extension, 'wb') as file:
+            file.write(payload)
+    return [os.path.basename(base_path) + extension for extension in payloads]
+
+def run_render_script(frame_id_code, script_path, orientation, dither, image_path, frame_output_name, timings):
+    """Runs a screen-type script for one frame and returns its log output and whether it succeeded.
+
+    Scripts with a render() entry point run in a render worker process, their stage durations are
+    added to timings. Other scripts are run from the command line and only timed as a whole.
+    """
+    log_output = ""
+
+    try:
+        status, result, render_timings = run_in_render_worker(script_path, image_path, orientation, dither)
+    except Exception as e:
+        log_output += f"Error for frame {frame_id_code}: {e}<br>"
+        return log_output, False
+
+    if status == 'ok':
+        timings.update(render_timings)
+        start_time = time.perf_counter()
+        filenames = write_render_payloads(result, frame_output_name)
+        timings['write'] = time.perf_counter() - start_time
+        log_output += f"Output for frame {frame_id_code}: Rendered {os.path.basename(image_path)} to {', '.join(filenames)}<br>"
+        return log_output, True
+    if status == 'error':
+        log_output += f"Error for frame {frame_id_code}: {result}<br>"
+        return log_output, False
+
+    # Run scripts without a usable render() entry point from the command line
+    if status == 'unavailable':
+        log_output += f"Could not load {os.path.basename(script_path)} in process, running it as a script: {result}<br>"
+
+    command = [
+        "python3", script_path,
+        orientation,
+        image_path,
+        frame_output_name
+    ]
+    # Only pass a dither algorithm other than the default, scripts without the option take exactly three arguments
+    if dither != DEFAULT_DITHER:
+        command.append(dither)
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        stdout, stderr = process.communicate(timeout=RENDER_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        # Kill a hung script so it frees its worker
+        process.kill()
+        stdout, stderr = process.communicate()
+        log_output += f"Error for frame {frame_id_code}: script killed after {RENDER_TIMEOUT} seconds<br>"
+
+    # Capture stdout and stderr
+    log_output += f"Output for frame {frame_id_code}: {stdout.decode()}<br>"
+    if stderr:
+        log_output += f"Error for frame {frame_id_code}: {stderr.decode()}<br>"
+
+    return log_output, process.returncode == 0
+
+def render_frame(frame_id_code, screen_type_name, script_path, orientation, dither, image_path, frame_output_name, scheduled_for=None):
+    """Renders one frame with its screen-type script, or reuses a cached render, and returns the log output for it.
+
+    scheduled_for is the time the scheduler planned the render for, the delay until it starts here is the scheduler lag.
+    """
+    if scheduled_for:
+        observe_scheduler_lag(frame_id_code, scheduled_for)
+    output_folder = os.path.dirname(frame_output_name)
+    base_path = os.path.splitext(frame_output_name)[0]
+    os.makedirs(output_folder, exist_ok=True)
+
+    # Reuse an earlier render of the same image for the same screen type and script
+    cache_key = get_render_cache_key(screen_type_name, script_path, orientation, dither, image_path)
+    if cache_key:
+        published = publish_cached_render(cache_key, base_path)
+        if published:
+            return f"Output for frame {frame_id_code}: Used cached render of {os.path.basename(image_path)} for {', '.join(published)}<br>"
+
+    # Render into a temporary folder and move the output files into place once they are complete
+    temp_path = tempfile.mkdtemp(prefix='render-', dir=output_folder)
+    timings = {}
+    try:
+        start_time = time.time()
+        log_output, rendered = run_render_script(frame_id_code, script_path, orientation, dither, image_path, os.path.join(temp_path, os.path.basename(frame_output_name)), timings)
+        if rendered:
+            timings['total'] = time.time() - start_time
+            record_render_duration(screen_type_name, timings['total'])
+            if cache_key:
+                store_cached_render(cache_key, temp_path)
+            filenames = os.listdir(temp_path)
+            for filename in filenames:
+                os.replace(os.path.join(temp_path, filename), os.path.join(output_folder, filename))
+            precompress_frame_files(output_folder, filenames)
+    except Exception as e:
+        record_render_failure(frame_id_code, screen_type_name, str(e))
+        raise
+    finally:
+        shutil.rmtree(temp_path, ignore_errors=True)
+
+    if not rendered:
+        record_render_failure(frame_id_code, screen_type_name, log_output.replace("<br>", "\n").strip())
+        return log_output
+
+    for stage, duration in timings.items():
+        observe_metric('imageserver_render_stage_seconds', duration, (screen_type_name, stage))
+    log_record('render', frame=frame_id_code, screen_type=screen_type_name, image=image_path, seconds={stage: round(duration, 4) for stage, duration in timings.items()})
+    return log_output
+
+def fill_render_queue(frame, screen_type, category, script_path):
+    """Renders images ahead of time until the frame's render queue holds RENDER_QUEUE_SIZE of them."""
+    log_output = ""
+    key = get_render_queue_key(frame, screen_type)
+    orientation = screen_type.orientation.lower()
+    queue_path = get_render_queue_path(frame.id_code)
+
+    queued = list_render_queue(frame.id_code, key)
+    if not queued:
+        os.makedirs(queue_path, exist_ok=True)
+        with open(os.path.join(queue_path, 'key.txt'), 'w') as key_file:
+            key_file.write(key)
+
+    for _ in range(RENDER_QUEUE_SIZE - len(queued)):
+        image_path = pick_random_image_from_category(category, orientation)
+        if not image_path:
+            log_output += f"No image found in category for frame {frame.id_code}<br>"
+            break
+
+        # Render into a temporary folder, the item only becomes visible once it is complete
+        item_name = f"item-{time.time_ns()}"
+        temp_path = os.path.join(queue_path, f"tmp-{item_name}")
+        os.makedirs(temp_path)
+        frame_output_name = os.path.join(temp_path, f"frame{frame.id_code}.h")
+        log_output += render_frame(frame.id_code, screen_type.name, script_path, orientation, screen_type.dither, image_path, frame_output_name)
+
+        if os.path.exists(frame_output_name):
+            os.rename(temp_path, os.path.join(queue_path, item_name))
+        else:
+            shutil.rmtree(temp_path, ignore_errors=True)
+            break
+
+    return log_output
+
+def fill_render_queues():
+    """Refills the render queue of every frame that has a category and screen type."""
+    log_output = ""
+    snapshot = get_config_snapshot()
+    for frame in snapshot.frames:
+        screen_type = snapshot.screen_types_by_name.get(frame.screen_type)
+        category = snapshot.categories_by_id.get(frame.category_id)
+        if not screen_type or not category:
+            continue
+
+        script_path = get_script_path(screen_type.name)
+        if script_path:
+            log_output += fill_render_queue(frame, screen_type, category, script_path)
+
+    return log_output
+
 @app.route('/externalevent=<linkname>=<action>', methods=['GET'])
 def toggle_external_event(linkname, action):
     # Find the external event by its Link Name
@@ -663,6 +1891,8 @@ def toggle_external_event(linkname, action):
             return f"External event '{linkname}' is already active.", 200
         
         for frame in external_event.frames:
+            if frame.category_id != external_event.category_id:
+                invalidate_render_queue(frame.id_code)  # Queued renders are for the old category
             frame.category_id = external_event.category_id
             frame.active_wake_up_times = external_event.event_times  # Set wake-up times from the event
             db.session.add(frame)
@@ -671,6 +1901,8 @@ def toggle_external_event(linkname, action):
             write_wake_up_times_to_file(frame.id_code, frame.active_wake_up_times)
         
         db.session.commit()
+        invalidate_config_snapshot()
+        rebuild_render_schedule()
         return f"External event '{linkname}' activated.", 200
 
     elif action == 'off':
@@ -680,6 +1912,8 @@ def toggle_external_event(linkname, action):
             return f"External event '{linkname}' is already inactive.", 200
         
         for frame in external_event.frames:
+            if frame.category_id is not None:
+                invalidate_render_queue(frame.id_code)  # Queued renders are for the event's category
             frame.category_id = None  # Reset category if needed
             frame.active_wake_up_times = frame.wake_up_times  # Reset to default wake-up times
             db.session.add(frame)
@@ -688,6 +1922,8 @@ def toggle_external_event(linkname, action):
             write_wake_up_times_to_file(frame.id_code, frame.active_wake_up_times)
         
         db.session.commit()
+        invalidate_config_snapshot()
+        rebuild_render_schedule()
         return f"External event '{linkname}' deactivated.", 200
     
     else:
@@ -704,86 +1940,551 @@ def run_script():
     # Render output to the webpage
     return render_template_string(f"<h1>Script Output:</h1><p>{output}</p>")
 
+def observe_scheduler_lag(frame_id_code, scheduled_for):
+    """Records how much later than scheduled a frame's render started, or its queued render was published."""
+    lag = (datetime.now() - scheduled_for).total_seconds()
+    observe_metric('imageserver_scheduler_lag_seconds', lag)
+    log_record('render_started', frame=frame_id_code, render_at=scheduled_for, lag_seconds=round(lag, 3))
+
+def start_frame_renders(frames, render_times=None):
+    """Picks an image for each frame and submits its render to the worker pool.
+
+    render_times maps the ids of frames rendered by the scheduler to the time their render was scheduled for,
+    the scheduler lag is measured when the render starts on a worker. Returns the log output so far and a
+    (frame id code, future) pair per submitted render.
+    """
+    render_times = render_times or {}
+    log_output = ""
+    renders = []
+    snapshot = get_config_snapshot()
+    for frame in frames:
+        screen_type = snapshot.screen_types_by_name.get(frame.screen_type)
+        if not screen_type:
+            log_output += f"No screen type found for frame {frame.id_code}<br>"
+            continue
+
+        script_path = get_script_path(screen_type.name)
+        if not script_path:
+            log_output += f"No script path found for screen type {screen_type.name}<br>"
+            continue
+
+        orientation = screen_type.orientation.lower()
+
+        category = snapshot.categories_by_id.get(frame.category_id)
+        if not category:
+            log_output += f"No category found for frame {frame.id_code}<br>"
+            continue
+
+        # Publish an image rendered ahead of time if one is queued
+        published = publish_queued_render(frame.id_code, get_render_queue_key(frame, screen_type))
+        if published:
+            log_output += f"Output for frame {frame.id_code}: Published queued render {', '.join(published)}<br>"
+            if frame.id in render_times:
+                observe_scheduler_lag(frame.id_code, render_times[frame.id])
+            continue
+
+        random_image_path = pick_random_image_from_category(category, orientation)
+        if not random_image_path:
+            log_output += f"No image found in category for frame {frame.id_code}<br>"
+            continue
+
+        # Define the frame output path within the loop
+        frame_output_name = os.path.join(STATIC_FOLDER_PATH, f"frame{frame.id_code}.h")
+
+        # Render the frame on the worker pool
+        future = render_executor.submit(render_frame, frame.id_code, screen_type.name, script_path, orientation, screen_type.dither, random_image_path, frame_output_name, render_times.get(frame.id))
+        renders.append((frame.id_code, future))
+
+    return log_output, renders
+
+def collect_frame_renders(renders):
+    """Waits for submitted renders and returns their log output, a hung render does not hold up the others."""
+    log_output = ""
+    for frame_id_code, future in renders:
+        try:
+            log_output += future.result(timeout=RENDER_TIMEOUT)
+        except FutureTimeoutError:
+            log_output += f"Error for frame {frame_id_code}: render did not finish within {RENDER_TIMEOUT} seconds<br>"
+        except Exception as e:
+            log_output += f"Error for frame {frame_id_code}: {e}<br>"
+    return log_output
+
 def check_and_run_scripts_for_upcoming_hour():
+    """Renders every frame with a wake-up time in the upcoming hour, used by /runscript."""
     log_output = ""  # Collect logs here
     with app.app_context():
         try:
             upcoming_hour = (datetime.now() + timedelta(minutes=30)).hour
 
-            frames = PhotoFrame.query.all()
-            for frame in frames:
-                if frame.active_wake_up_times:
-                    active_hours = [int(hour.strip()) for hour in frame.active_wake_up_times.split(',')]
-                    if upcoming_hour in active_hours:
-                        screen_type = ScreenType.query.filter_by(name=frame.screen_type).first()
-                        if not screen_type:
-                            log_output += f"No screen type found for frame {frame.id_code}<br>"
-                            continue
-
-                        script_path = get_script_path(screen_type.name)
-                        if not script_path:
-                            log_output += f"No script path found for screen type {screen_type.name}<br>"
-                            continue
-
-                        orientation = screen_type.orientation.lower()
-
-                        category = Category.query.get(frame.category_id)
-                        if not category:
-                            log_output += f"No category found for frame {frame.id_code}<br>"
-                            continue
-
-                        random_image_path = pick_random_image_from_category(category, orientation)
-                        if not random_image_path:
-                            log_output += f"No image found in category for frame {frame.id_code}<br>"
-                            continue
-
-                        # Define the frame output path within the loop
-                        frame_output_name = os.path.join(STATIC_FOLDER_PATH, f"frame{frame.id_code}.h")
-
-                        command = [
-                            "python3", script_path,
-                            orientation,
-                            random_image_path,
-                            frame_output_name
-                        ]
-                        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                        stdout, stderr = process.communicate()
-                        
-                        # Capture stdout and stderr
-                        log_output += f"Output for frame {frame.id_code}: {stdout.decode()}<br>"
-                        if stderr:
-                            log_output += f"Error for frame {frame.id_code}: {stderr.decode()}<br>"
+            frames = get_config_snapshot().frames
+            due_frames = [frame for frame in frames if any(hour == upcoming_hour for hour, _ in parse_wake_up_times(frame.active_wake_up_times))]
+
+            output, renders = start_frame_renders(due_frames)
+            log_output += output
+            log_output += collect_frame_renders(renders)
 
         except Exception as e:
             log_output += f"Exception occurred: {e}<br>"
     
     return log_output
 
+def build_render_schedule(now):
+    """Computes when to render each frame for each of its wake-up times in the next day."""
+    schedule = []
+    for frame in get_config_snapshot().frames:
+        for hour, minute in parse_wake_up_times(frame.active_wake_up_times):
+            wake_at = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+            if wake_at <= now:
+                wake_at += timedelta(days=1)
+            schedule_frame_render(schedule, frame.id, frame.screen_type, wake_at, now)
+    return schedule
+
+def schedule_frame_render(schedule, frame_id, screen_type_name, wake_at, now):
+    """Pushes a render onto the schedule, its lead time ahead of the wake-up time but not in the past."""
+    render_at = max(now, wake_at - timedelta(seconds=get_render_lead_time(screen_type_name)))
+    heapq.heappush(schedule, (render_at, wake_at, frame_id, screen_type_name))
+
+def rebuild_render_schedule():
+    """Has schedule_task recompute its renders, called when frames or their active wake-up times change."""
+    global render_schedule_dirty
+    with render_schedule_condition:
+        render_schedule_dirty = True
+        render_schedule_condition.notify()
+
+def log_frame_render(future):
+    """Prints the log output of a render started by schedule_task."""
+    try:
+        print(future.result().replace("<br>", "\n").strip())
+    except Exception as e:
+        print(f"Error executing script: {e}")
+
 def schedule_task():
-    """Run check_and_run_scripts_for_upcoming_hour once every hour at the :31 minute mark."""
+    """Render each frame just before each of its wake-up times.
+
+    Renders are kept in a heap ordered by render time, which is the wake-up time minus a lead time
+    based on the render durations recently measured for the frame's screen type.
+    """
+    global render_schedule, render_schedule_dirty
     while True:
-        now = datetime.now()
-        # Calculate the next :31 minute mark
-        if now.minute < 31:
-            next_run = now.replace(minute=31, second=0, microsecond=0)
-        else:
-            next_run = (now + timedelta(hours=1)).replace(minute=31, second=0, microsecond=0)
+        with render_schedule_condition:
+            now = datetime.now()
+            if render_schedule_dirty:
+                render_schedule_dirty = False
+                try:
+                    with app.app_context():
+                        render_schedule = build_render_schedule(now)
+                except Exception as e:
+                    print(f"Error scheduling renders: {e}")
+                    render_schedule = []
+
+            if not render_schedule or render_schedule[0][0] > now:
+                # Sleep until the next render, waking up regularly in case the clock changed
+                timeout = RENDER_SCHEDULE_MAX_SLEEP
+                if render_schedule:
+                    timeout = min(timeout, (render_schedule[0][0] - now).total_seconds())
+                render_schedule_condition.wait(timeout)
+                continue
+
+            # Take every render that is due, a frame with several wake-up times due in this pass is rendered once
+            due_frame_ids = []
+            due_render_times = {}
+            while render_schedule and render_schedule[0][0] <= now:
+                render_at, wake_at, frame_id, screen_type_name = heapq.heappop(render_schedule)
+                schedule_frame_render(render_schedule, frame_id, screen_type_name, wake_at + timedelta(days=1), now)
+                if (frame_id, wake_at) not in dispatched_renders:
+                    dispatched_renders[(frame_id, wake_at)] = render_at
+                    # The heap yields the earliest render time of a frame first, its lag is the one observed
+                    if frame_id not in due_render_times:
+                        due_frame_ids.append(frame_id)
+                        due_render_times[frame_id] = render_at
+
+                    log_record('render_dispatched', frame_id=frame_id, wake_at=wake_at, render_at=render_at)
+
+            # Forget renders for wake-up times that have passed
+            for key in [key for key in dispatched_renders if key[1] < now - timedelta(days=1)]:
+                del dispatched_renders[key]
+
+        if not due_frame_ids:
+            continue
 
-        wait_seconds = (next_run - now).total_seconds()
-        time.sleep(wait_seconds)  # Sleep until the next :31 minute mark
-        
         # Run the script
         with app.app_context():
             try:
-                check_and_run_scripts_for_upcoming_hour()
+                frames_by_id = get_config_snapshot().frames_by_id
+                frames = [frames_by_id[frame_id] for frame_id in due_frame_ids if frame_id in frames_by_id]
+                log_output, renders = start_frame_renders(frames, due_render_times)
+                if log_output:
+                    print(log_output.replace("<br>", "\n").strip())
+                for _, future in renders:
+                    future.add_done_callback(log_frame_render)
             except Exception as e:
                 print(f"Error executing script: {e}")
 
-# Start the background thread for scheduled execution
-task_thread = threading.Thread(target=schedule_task)
-task_thread.daemon = True  # Ensure the thread stops when the program exits
-task_thread.start()
+# Renders started by /frame/<id_code>/image, keyed by frame id code, so concurrent requests share one
+frame_image_renders = {}
+frame_image_renders_lock = threading.Lock()
+
+def is_frame_image_fresh(frame, image_path):
+    """Checks if a frame's image file was written for the frame's most recent wake-up time."""
+    if not os.path.exists(image_path):
+        return False
+
+    now = datetime.now()
+    lead_time = timedelta(seconds=get_render_lead_time(frame.screen_type))
+    wake_times = []
+    for hour, minute in parse_wake_up_times(frame.active_wake_up_times):
+        # The latest wake-up time whose render was due by now
+        wake_at = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+        if wake_at - lead_time > now:
+            wake_at -= timedelta(days=1)
+        wake_times.append(wake_at)
+    if not wake_times:
+        return True
+
+    # Allow for a render that started earlier than the current lead time
+    return os.path.getmtime(image_path) >= (max(wake_times) - 2 * lead_time).timestamp()
+
+def render_frame_on_demand(frame):
+    """Renders a frame right away and returns the log output, joining a render already running for it."""
+    with frame_image_renders_lock:
+        future = frame_image_renders.get(frame.id_code)
+        started_here = future is None
+        if started_here:
+            future = Future()
+            frame_image_renders[frame.id_code] = future
+
+    if started_here:
+        try:
+            log_output, renders = start_frame_renders([frame])
+            log_output += collect_frame_renders(renders)
+            future.set_result(log_output)
+        except Exception as e:
+            future.set_exception(e)
+        finally:
+            with frame_image_renders_lock:
+                del frame_image_renders[frame.id_code]
+
+    return future.result(timeout=RENDER_TIMEOUT)
+
+def send_frame_file(filename, mimetype):
+    """Sends a file from the static folder with a strong ETag and Last-Modified, answering conditional requests with 304.
+
+    A precompressed copy is sent when the client accepts its encoding (with a q-value above 0) and it is
+    not older than the file.
+    """
+    file_path = os.path.join(STATIC_FOLDER_PATH, filename)
+    file_mtime = os.path.getmtime(file_path)
+
+    send_path = file_path
+    content_encoding = None
+    for encoding, extension, _ in PAYLOAD_ENCODINGS:
+        encoded_path = file_path + extension
+        if request.accept_encodings.quality(encoding) > 0 and os.path.exists(encoded_path) and os.path.getmtime(encoded_path) >= file_mtime:
+            send_path = encoded_path
+            content_encoding = encoding
+            break
+
+    # Every encoding has its own file, so the ETag of each representation differs
+    stat = os.stat(send_path)
+    etag = f"{stat.st_mtime_ns:x}-{stat.st_size:x}"
+    response = send_file(send_path, mimetype=mimetype, etag=etag, last_modified=file_mtime, max_age=0, conditional=True)
+    if content_encoding:
+        response.headers['Content-Encoding'] = content_encoding
+    response.vary.add('Accept-Encoding')
+    return response
+
+def get_frame_or_404(id_code):
+    """Returns the frame with the id code from the configuration snapshot, or aborts with 404."""
+    frame = get_config_snapshot().frames_by_code.get(id_code)
+    if not frame:
+        abort(404)
+    return frame
+
+@app.route('/frame/<id_code>/wake_up_times')
+def frame_wake_up_times(id_code):
+    """Serves a frame's active wake-up times, the same content as static/frameXXX.txt."""
+    frame = get_frame_or_404(id_code)
+    filename = f"frame{frame.id_code}.txt"
+    if not os.path.exists(os.path.join(STATIC_FOLDER_PATH, filename)):
+        write_wake_up_times_to_file(frame.id_code, frame.active_wake_up_times)
+    return send_frame_file(filename, 'text/plain')
+
+@app.route('/frame/<id_code>/image')
+def frame_image(id_code):
+    """Serves a frame's image, rendering it first if the pre-rendered file is missing or stale.
+
+    The format query parameter selects the header file (h, the default) or the packed binary payload (bin).
+    """
+    frame = get_frame_or_404(id_code)
+    extension = request.args.get('format', 'h')
+    if extension not in ('h', 'bin'):
+        return "Invalid format. Use 'h' or 'bin'.", 400
+
+    filename = f"frame{frame.id_code}.{extension}"
+    image_path = os.path.join(STATIC_FOLDER_PATH, filename)
+    # A render writes both payloads when the screen-type script produces both, some scripts only write the header
+    other_path = os.path.join(STATIC_FOLDER_PATH, f"frame{frame.id_code}.{'bin' if extension == 'h' else 'h'}")
+    if not is_frame_image_fresh(frame, image_path):
+        # The other payload is up to date without this one, so the screen type does not produce it
+        if is_frame_image_fresh(frame, other_path):
+            return f"The screen type of frame {frame.id_code} does not produce .{extension} files", 404
+        try:
+            log_output = render_frame_on_demand(frame)
+        except Exception as e:
+            log_output = f"Exception occurred: {e}"
+        if not is_frame_image_fresh(frame, image_path):
+            if is_frame_image_fresh(frame, other_path):
+                return f"The screen type of frame {frame.id_code} does not produce .{extension} files", 404
+            if not os.path.exists(image_path):
+                return f"No image could be rendered for frame {frame.id_code}: {log_output}", 503
+
+    return send_frame_file(filename, 'text/plain' if extension == 'h' else 'application/octet-stream')
+
+def get_payload_request():
+    """Returns (frame id code, file type) when the request is for a frame payload (h, bin or txt), or None."""
+    if request.endpoint == 'static':
+        filename = os.path.basename(request.path)
+        if filename.startswith('frame') and '.' in filename:
+            frame_id_code, file_type = filename[len('frame'):].split('.')[:2]
+            return frame_id_code, file_type
+    elif request.endpoint == 'frame_image':
+        return request.view_args['id_code'], request.args.get('format', 'h')
+    elif request.endpoint == 'frame_wake_up_times':
+        return request.view_args['id_code'], 'txt'
+    return None
+
+def record_frame_fetch(frame_id_code, fetch):
+    """Stores a fetch in the database, where every server process sees it, keeping the last FRAME_FETCH_HISTORY per frame.
+
+    fetch is (time, file type, bytes sent, duration, status code, render-to-fetch gap in seconds or None, late render).
+    """
+    fetch_time, file_type, bytes_sent, duration, status, gap, late = fetch
+    db.session.add(FrameFetch(
+        frame_id_code=frame_id_code, time=fetch_time, file_type=file_type, bytes_sent=bytes_sent,
+        duration=duration, status=status, render_to_fetch=gap, late_render=late
+    ))
+    kept_ids = db.select(FrameFetch.id).where(FrameFetch.frame_id_code == frame_id_code).order_by(FrameFetch.id.desc()).limit(FRAME_FETCH_HISTORY)
+    db.session.execute(db.delete(FrameFetch).where(FrameFetch.frame_id_code == frame_id_code, FrameFetch.id.not_in(kept_ids)))
+    db.session.commit()
 
+def load_frame_fetches(frame_id_codes):
+    """Returns the remembered fetches of the frames, oldest first, as lists of fetch tuples keyed by frame id code."""
+    fetches = {frame_id_code: [] for frame_id_code in frame_id_codes}
+    rows = db.session.execute(db.select(FrameFetch).where(FrameFetch.frame_id_code.in_(fetches)).order_by(FrameFetch.id)).scalars()
+    for row in rows:
+        fetches[row.frame_id_code].append((row.time, row.file_type, row.bytes_sent, row.duration, row.status, row.render_to_fetch, row.late_render))
+    return fetches
+
+def nearest_wake_up_time(wake_up_times, moment):
+    """Returns the wake-up time closest to moment (a datetime), or None if there are none."""
+    candidates = [
+        datetime.combine(moment.date() + timedelta(days=days), datetime.min.time()).replace(hour=hour, minute=minute)
+        for days in (-1, 0, 1) for hour, minute in wake_up_times
+    ]
+    return min(candidates, key=lambda wake_at: abs(wake_at - moment), default=None)
+
+def get_frame_telemetry(frame, fetches, now):
+    """Summarizes a frame's recent fetches: last fetch, render-to-fetch gap, late renders, missed wake-ups and drift.
+
+    Missed wake-ups are only counted after the oldest remembered fetch, and are None for a frame without any:
+    a frame that downloads its files where the server does not see it (e.g. from Apache's /static alias) is never
+    reported as missing its wake-ups.
+    """
+    wake_up_times = parse_wake_up_times(frame.active_wake_up_times)
+
+    # Offset of each fetch from the wake-up time it belongs to, positive when the frame was late
+    fetch_times = [datetime.fromtimestamp(fetch[0]) for fetch in fetches]
+    offsets = []
+    for fetch_time in fetch_times:
+        wake_at = nearest_wake_up_time(wake_up_times, fetch_time)
+        if wake_at and abs((fetch_time - wake_at).total_seconds()) <= FRAME_FETCH_WINDOW:
+            offsets.append((fetch_time - wake_at).total_seconds())
+
+    # Wake-up times in the last day without a fetch, only where the remembered fetches cover them
+    window = timedelta(seconds=FRAME_FETCH_WINDOW)
+    missed_wake_ups = None
+    if fetch_times:
+        missed_wake_ups = 0
+        for days in (-1, 0):
+            for hour, minute in wake_up_times:
+                wake_at = datetime.combine(now.date() + timedelta(days=days), datetime.min.time()).replace(hour=hour, minute=minute)
+                if wake_at - window < max(fetch_times[0], now - timedelta(days=1)) or wake_at + window > now:
+                    continue
+                if not any(abs(fetch_time - wake_at) <= window for fetch_time in fetch_times):
+                    missed_wake_ups += 1
+
+    image_fetches = [fetch for fetch in fetches if fetch[1] != 'txt']
+    return {
+        'fetches': len(fetches),
+        'last_fetch': fetch_times[-1] if fetch_times else None,
+        'render_to_fetch': image_fetches[-1][5] if image_fetches else None,
+        'late_renders': sum(1 for fetch in image_fetches if fetch[6]),
+        'missed_wake_ups': missed_wake_ups,
+        'drift': statistics.median(offsets) if offsets else None
+    }
+
+@app.before_request
+def start_payload_fetch():
+    """Notes when a frame payload fetch started and whether the image was rendered in time for it."""
+    payload_request = get_payload_request()
+    if not payload_request:
+        return
+
+    # Only fetches of configured frames are recorded
+    frame_id_code, file_type = payload_request
+    frame = get_config_snapshot().frames_by_code.get(frame_id_code)
+    if not frame:
+        return
+    late = file_type != 'txt' and not is_frame_image_fresh(frame, os.path.join(STATIC_FOLDER_PATH, f"frame{frame_id_code}.{file_type}"))
+    g.payload_fetch = (frame_id_code, file_type, time.time(), late)
+
+@app.after_request
+def count_payload_bytes(response):
+    """Counts the requests for frame payloads and the bytes sent for them, and records the fetch for the frame."""
+    payload_fetch = g.pop('payload_fetch', None)
+    if not payload_fetch:
+        return response
+
+    frame_id_code, file_type, start_time, late = payload_fetch
+    bytes_sent = (response.content_length or 0) if response.status_code == 200 else 0
+    inc_metric('imageserver_payload_requests_total', (file_type, response.status_code))
+    if response.status_code == 200:
+        encoding = response.headers.get('Content-Encoding', 'identity')
+        inc_metric('imageserver_payload_bytes_served_total', (file_type, encoding), bytes_sent)
+
+    # Time from the render of the served image to the end of the request, which includes a render on demand
+    end_time = time.time()
+    gap = None
+    if file_type != 'txt' and response.status_code in (200, 304):
+        try:
+            gap = end_time - os.path.getmtime(os.path.join(STATIC_FOLDER_PATH, f"frame{frame_id_code}.{file_type}"))
+        except OSError:
+            pass
+
+    # The duration covers handling the request, including a render on demand, but not sending the file.
+    # Telemetry must never fail a frame's download, e.g. when the database stays locked.
+    try:
+        record_frame_fetch(frame_id_code, (start_time, file_type, bytes_sent, end_time - start_time, response.status_code, gap, late))
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error recording fetch for frame {frame_id_code}: {e}")
+    return response
+
+@app.route('/frame/<id_code>/telemetry')
+def frame_telemetry(id_code):
+    """Reports a frame's recent payload fetches and their summary, for tuning render lead times."""
+    frame = get_frame_or_404(id_code)
+    fetches = load_frame_fetches([frame.id_code])[frame.id_code]
+    summary = get_frame_telemetry(frame, fetches, datetime.now())
+    summary['last_fetch'] = summary['last_fetch'].isoformat(timespec='seconds') if summary['last_fetch'] else None
+    return jsonify({
+        'summary': summary,
+        'fetches': [
+            {'time': fetch_time, 'file': file_type, 'bytes': bytes_sent, 'duration': duration, 'status': status, 'render_to_fetch': gap, 'late_render': late}
+            for fetch_time, file_type, bytes_sent, duration, status, gap, late in fetches
+        ]
+    })
+
+@app.route('/metrics')
+def get_metrics():
+    """Serves render, index, scheduler and payload metrics in the Prometheus text format."""
+    return format_metrics(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+def render_ahead_task():
+    """Keep the render queues filled in the background, at low priority and only while the server is idle."""
+    # Lower the priority of this thread and of the scripts it starts (Linux only)
+    try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), RENDER_AHEAD_NICENESS)
+    except (AttributeError, OSError):
+        pass
+
+    while True:
+        time.sleep(RENDER_AHEAD_INTERVAL)
+
+        # Skip this round while the CPUs are busy
+        if hasattr(os, 'getloadavg') and os.getloadavg()[0] >= RENDER_WORKERS:
+            continue
+
+        with app.app_context():
+            try:
+                fill_render_queues()
+            except Exception as e:
+                print(f"Error filling render queues: {e}")
+
+def start_background_services():
+    """Starts the event, scheduler and render-ahead threads."""
+    # Start the background thread that applies event starts and ends
+    event_thread = threading.Thread(target=check_events)
+    event_thread.daemon = True  # Daemonize thread
+    event_thread.start()
+
+    # Start the background thread for scheduled execution
+    task_thread = threading.Thread(target=schedule_task)
+    task_thread.daemon = True  # Ensure the thread stops when the program exits
+    task_thread.start()
+
+    # Start the background thread that renders images ahead of time
+    render_ahead_thread = threading.Thread(target=render_ahead_task)
+    render_ahead_thread.daemon = True
+    render_ahead_thread.start()
+
+# Open lock file of the leader, held for the life of the process; the lock is released when the process exits or dies
+leader_lock_file = None
+
+def try_become_leader():
+    """Takes the leader lock if no other process holds it and returns whether this process is now the leader."""
+    global leader_lock_file
+    lock_file = open(LEADER_LOCK_PATH, 'a+')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return False
+
+    # Record the leader's process id for whoever is looking
+    lock_file.seek(0)
+    lock_file.truncate()
+    lock_file.write(f"{os.getpid()}\n")
+    lock_file.flush()
+    leader_lock_file = lock_file
+    return True
+
+def leader_task():
+    """Runs the background services in only one of the server's processes.
+
+    Every process waits for the leader lock, the one holding it runs the services and the others take
+    over when it is released, which the OS does when the leader exits or dies. The leader then follows
+    configuration changes made through the other processes, which cannot wake its threads directly.
+    """
+    # Without advisory locks every process runs the services
+    if fcntl is None:
+        start_background_services()
+        return
+
+    while True:
+        try:
+            if try_become_leader():
+                break
+        except OSError as e:
+            print(f"Error taking the leader lock {LEADER_LOCK_PATH}: {e}")
+        time.sleep(LEADER_POLL_INTERVAL)
+
+    print(f"Process {os.getpid()} is running the background services")
+    start_background_services()
+
+    config_version = get_config_version()
+    while True:
+        time.sleep(LEADER_POLL_INTERVAL)
+        if get_config_version() != config_version:
+            config_version = get_config_version()
+            rebuild_event_queue()
+            rebuild_render_schedule()
+
+# Start the thread that runs the background services once this process is the leader
+leader_thread = threading.Thread(target=leader_task)
+leader_thread.daemon = True
+if BACKGROUND_SERVICES:
+    leader_thread.start()
 
 if __name__ == '__main__':
     app.run()
\ No newline at end of file
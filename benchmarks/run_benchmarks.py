@@ -0,0 +1,362 @@
+"""Benchmarks for the render, index and scheduling hot paths.
+
+Run from the repository root on any Linux box with the server's dependencies installed:
+
+    python3 benchmarks/run_benchmarks.py --output results.json
+
+The app is imported from a throw-away copy in a temporary folder, with its own database, image
+folders and static folder, so a real installation is never touched. Every stage is timed
+--repeat times and then run once more for its peak memory, both under tracemalloc and as peak
+resident memory. Results are written as JSON, so runs on the same hardware can be compared
+over time.
+"""
+import argparse
+import contextlib
+import importlib.util
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+import numpy as np
+from PIL import Image
+from sqlalchemy import event
+
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT_PATH = os.path.join(REPO_PATH, 'pyscripts', '6color73i.py')
+
+# Stub screen-type scripts for the scheduler benchmark, one in-process and one command-line only
+STUB_RENDER_SCRIPT = '''def render(image, orientation):
+    return b'stub'
+'''
+STUB_CLI_SCRIPT = '''import sys
+
+with open(sys.argv[3], 'w') as output_file:
+    output_file.write('stub')
+'''
+
+
+def reset_peak_rss():
+    """Resets the peak resident memory of this process, returns False where that is not supported (Linux only)."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def read_peak_rss():
+    """Returns the peak resident memory of this process in bytes since the last reset."""
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) * 1024
+    return None
+
+
+def measure(function, repeat, memory):
+    """Times function repeat times and returns the timings and, if memory is set, the peak memory of one more run.
+
+    peak_bytes counts Python allocations, including NumPy arrays, and peak_rss_bytes the whole
+    process, which also covers memory that Pillow allocates outside Python.
+    """
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        runs.append(time.perf_counter() - start)
+
+    result = {
+        'seconds': {
+            'min': min(runs),
+            'median': statistics.median(runs),
+            'runs': runs
+        }
+    }
+    if memory:
+        rss_reset = reset_peak_rss()
+        tracemalloc.start()
+        try:
+            function()
+            result['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        if rss_reset:
+            result['peak_rss_bytes'] = read_peak_rss()
+    return result
+
+
+def parse_sizes(value):
+    """Parses comma-separated WIDTHxHEIGHT sizes."""
+    return [tuple(int(part) for part in size.split('x')) for size in value.split(',') if size]
+
+
+def synthetic_image(width, height, seed=0):
+    """Returns a reproducible photo-like RGB image: smooth gradients with noise."""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width]
+    pixels = np.stack([x / width * 255, y / height * 255, (x + y) / (width + height) * 255], axis=-1)
+    pixels += rng.normal(0, 24, pixels.shape)
+    return Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+
+
+def load_module(name, path):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def check_flat_palette(script):
+    """Raises AssertionError if a dither algorithm changes a flat area of a palette color, its timings would be meaningless."""
+    failures = []
+    for name, algorithm in script.DITHER_ALGORITHMS.items():
+        for index, color in enumerate(script.PALETTE):
+            pixels = np.full((64, 64, 3), color, dtype=np.float32)
+            changed = int(np.count_nonzero(algorithm(pixels) != index))
+            if changed:
+                failures.append(f"{name} changes {changed} of 4096 pixels of flat {color}")
+    if failures:
+        raise AssertionError("; ".join(failures))
+
+
+def bench_render(args, workdir):
+    """Times the stages of 6color73i.py on synthetic JPEG source images and each dither algorithm on several panel sizes."""
+    script = load_module('benchmark_6color73i', SCRIPT_PATH)
+    check_flat_palette(script)
+    results = {'sources': {}, 'dither': {}}
+
+    for width, height in parse_sizes(args.resolutions):
+        source_path = os.path.join(workdir, f"source{width}x{height}.jpg")
+        synthetic_image(width, height).save(source_path, quality=90)
+
+        def decode():
+            with Image.open(source_path) as image:
+                return script.load_image(image, 'horizontal')
+
+        def render():
+            with Image.open(source_path) as image:
+                return script.render(image, 'horizontal')
+
+        decoded = decode()
+        prepared = script.prepare_image(decoded, 'horizontal')
+        pixels = np.array(prepared, dtype=np.float32)
+        indices = script.floyd_steinberg(pixels)
+
+        results['sources'][f"{width}x{height}"] = {
+            'decode': measure(decode, args.repeat, args.memory),
+            'prepare': measure(lambda: script.prepare_image(decoded, 'horizontal'), args.repeat, args.memory),
+            'dither': measure(lambda: script.floyd_steinberg(pixels), args.repeat, args.memory),
+            'encode_header': measure(lambda: script.encode_header(indices), args.repeat, args.memory),
+            'encode_bin': measure(lambda: script.encode_bin(indices), args.repeat, args.memory),
+            'render': measure(render, args.repeat, args.memory)
+        }
+
+    for width, height in parse_sizes(args.dither_sizes):
+        pixels = np.array(synthetic_image(width, height, seed=1), dtype=np.float32)
+        results['dither'][f"{width}x{height}"] = {
+            name: measure(lambda: algorithm(pixels), args.repeat, args.memory)
+            for name, algorithm in script.DITHER_ALGORITHMS.items()
+        }
+
+    return results
+
+
+def load_app(workdir):
+    """Imports a copy of app.py that keeps all of its files in workdir."""
+    app_path = os.path.join(workdir, 'app')
+    os.makedirs(os.path.join(app_path, 'pyscripts'), exist_ok=True)
+    shutil.copy(os.path.join(REPO_PATH, 'app.py'), app_path)
+    shutil.copy(os.path.join(REPO_PATH, 'render_worker.py'), app_path)
+    with open(os.path.join(app_path, 'pyscripts', 'stub_render.py'), 'w') as script_file:
+        script_file.write(STUB_RENDER_SCRIPT)
+    with open(os.path.join(app_path, 'pyscripts', 'stub_cli.py'), 'w') as script_file:
+        script_file.write(STUB_CLI_SCRIPT)
+
+    # Keep the scheduler, event and render-ahead threads from rendering while the benchmarks are timed
+    os.environ['IMAGESERVER_BACKGROUND_SERVICES'] = '0'
+    app_module = load_module('benchmark_app', os.path.join(app_path, 'app.py'))
+    app_module.SHARED_IMAGES_PATH = app_module.SHARED_IMAGES_BASE = os.path.join(workdir, 'shared_images')
+    app_module.LOCAL_IMAGES_PATH = app_module.LOCAL_IMAGES_BASE = os.path.join(workdir, 'local_images')
+    app_module.CACHE_FILE_PATH = os.path.join(workdir, 'image_cache.json')
+    app_module.STATIC_FOLDER_PATH = os.path.join(app_path, 'static')
+    app_module.RENDER_CACHE_PATH = os.path.join(app_path, 'render_cache')
+    app_module.RENDER_QUEUE_PATH = os.path.join(app_path, 'render_queue')
+    # Keep the background render-ahead thread from competing with the measurements
+    app_module.RENDER_QUEUE_SIZE = 0
+    return app_module
+
+
+def make_image_tree(folder_path, count, folders=20, seed=0):
+    """Writes count tiny JPEG and PNG images of mixed orientations, spread over subfolders."""
+    rng = random.Random(seed)
+    sizes = [(32, 24), (24, 32), (24, 24)]
+    for i in range(count):
+        subfolder = os.path.join(folder_path, f"folder{i % folders:02d}")
+        os.makedirs(subfolder, exist_ok=True)
+        width, height = rng.choice(sizes)
+        color = (rng.randrange(256), rng.randrange(256), rng.randrange(256))
+        extension = 'jpg' if i % 2 else 'png'
+        Image.new('RGB', (width, height), color).save(os.path.join(subfolder, f"image{i:06d}.{extension}"))
+
+
+def bench_index(args, app_module, workdir):
+    """Times a full index_folders run on an empty index, and an incremental one with nothing changed."""
+    results = {}
+    for count in [int(count) for count in args.index_sizes.split(',') if count]:
+        tree_path = os.path.join(workdir, f"tree{count}")
+        start = time.perf_counter()
+        make_image_tree(os.path.join(tree_path, 'local_images'), count)
+        generate_seconds = time.perf_counter() - start
+
+        app_module.LOCAL_IMAGES_PATH = app_module.LOCAL_IMAGES_BASE = os.path.join(tree_path, 'local_images')
+        app_module.SHARED_IMAGES_PATH = app_module.SHARED_IMAGES_BASE = os.path.join(tree_path, 'shared_images')
+
+        with app_module.app.app_context():
+            def full_index():
+                app_module.IndexedImage.query.delete()
+                app_module.db.session.commit()
+                app_module.index_folders()
+
+            results[str(count)] = {
+                'files': count,
+                'generate_seconds': generate_seconds,
+                'full': measure(full_index, args.repeat, args.memory),
+                'incremental': measure(app_module.index_folders, args.repeat, args.memory)
+            }
+            app_module.IndexedImage.query.delete()
+            app_module.db.session.commit()
+
+        shutil.rmtree(tree_path, ignore_errors=True)
+    return results
+
+
+def count_queries(app_module, function):
+    """Runs function once and returns the number of SQL statements it executed."""
+    statements = []
+    listener = lambda *args: statements.append(args[2])
+    event.listen(app_module.db.engine, 'before_cursor_execute', listener)
+    try:
+        function()
+    finally:
+        event.remove(app_module.db.engine, 'before_cursor_execute', listener)
+    return len(statements)
+
+
+def bench_scheduler(args, app_module, workdir):
+    """Times check_and_run_scripts_for_upcoming_hour with synthetic frames that are all due, for stub scripts."""
+    app_module.LOCAL_IMAGES_PATH = app_module.LOCAL_IMAGES_BASE = os.path.join(workdir, 'local_images')
+    app_module.SHARED_IMAGES_PATH = app_module.SHARED_IMAGES_BASE = os.path.join(workdir, 'shared_images')
+    make_image_tree(os.path.join(workdir, 'local_images', 'bench'), 200, folders=1)
+    # make_image_tree puts the images one folder deeper, move them up into the category folder
+    source_path = os.path.join(workdir, 'local_images', 'bench', 'folder00')
+    for filename in os.listdir(source_path):
+        os.replace(os.path.join(source_path, filename), os.path.join(workdir, 'local_images', 'bench', filename))
+    os.rmdir(source_path)
+
+    results = {}
+    with app_module.app.app_context():
+        app_module.index_folders()
+        category = app_module.Category(name='bench', linked_folders='Local - bench')
+        app_module.db.session.add(category)
+        for name, script in (('Stub render', 'stub_render.py'), ('Stub CLI', 'stub_cli.py')):
+            app_module.db.session.add(app_module.ScreenType(name=name, script_filename=script, orientation='Horizontal'))
+        app_module.db.session.commit()
+
+        all_hours = ','.join(str(hour) for hour in range(24))
+        for frame_count in [int(count) for count in args.frames.split(',') if count]:
+            for case, screen_type in (('in_process', 'Stub render'), ('subprocess', 'Stub CLI')):
+                app_module.PhotoFrame.query.delete()
+                for i in range(frame_count):
+                    app_module.db.session.add(app_module.PhotoFrame(
+                        id_code=f"{i:03X}"[-3:], name=f"Frame {i}", ip_address='127.0.0.1',
+                        wake_up_times=all_hours, active_wake_up_times=all_hours,
+                        screen_type=screen_type, category_id=category.id
+                    ))
+                app_module.db.session.commit()
+                app_module.invalidate_config_snapshot()
+
+                def uncached_run():
+                    shutil.rmtree(app_module.RENDER_CACHE_PATH, ignore_errors=True)
+                    app_module.check_and_run_scripts_for_upcoming_hour()
+
+                def select_and_submit():
+                    shutil.rmtree(app_module.RENDER_CACHE_PATH, ignore_errors=True)
+                    frames = app_module.get_config_snapshot().frames
+                    _, renders = app_module.start_frame_renders(frames)
+                    app_module.collect_frame_renders(renders)
+
+                results[f"{case}_{frame_count}"] = {
+                    'frames': frame_count,
+                    'queries': count_queries(app_module, uncached_run),
+                    'run': measure(uncached_run, args.repeat, args.memory),
+                    'run_cached': measure(app_module.check_and_run_scripts_for_upcoming_hour, args.repeat, args.memory),
+                    'select_and_render': measure(select_and_submit, args.repeat, args.memory)
+                }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the render, index and scheduling hot paths.")
+    parser.add_argument('--output', help="write the JSON results to this file instead of stdout")
+    parser.add_argument('--repeat', type=int, default=3, help="timed runs per stage (default 3)")
+    parser.add_argument('--no-memory', dest='memory', action='store_false', help="skip the peak memory runs")
+    parser.add_argument('--resolutions', default='800x480,1920x1080,4000x3000', help="source image sizes for the render stages")
+    parser.add_argument('--dither-sizes', default='400x240,800x480,1600x960', help="panel sizes for the dither stage")
+    parser.add_argument('--index-sizes', default='10000,100000', help="numbers of images to index")
+    parser.add_argument('--frames', default='100,300', help="numbers of frames for the scheduler")
+    parser.add_argument('--only', default='render,index,scheduler', help="comma-separated benchmarks to run")
+    args = parser.parse_args()
+    benchmarks = args.only.split(',')
+
+    results = {
+        'meta': {
+            'started': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'machine': platform.machine(),
+            'cpus': os.cpu_count(),
+            'numpy': np.__version__,
+            'pillow': Image.__version__,
+            'repeat': args.repeat
+        }
+    }
+
+    # The app logs to stdout, keep it apart from the results
+    workdir = tempfile.mkdtemp(prefix='imageserver-benchmark-')
+    try:
+        with contextlib.redirect_stdout(sys.stderr):
+            if 'render' in benchmarks:
+                results['render'] = bench_render(args, workdir)
+
+            if 'index' in benchmarks or 'scheduler' in benchmarks:
+                app_module = load_app(workdir)
+                if 'index' in benchmarks:
+                    results['index'] = bench_index(args, app_module, workdir)
+                if 'scheduler' in benchmarks:
+                    results['scheduler'] = bench_scheduler(args, app_module, workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    # Peak resident memory of the whole benchmark process, in bytes on Linux
+    results['meta']['max_rss_bytes'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
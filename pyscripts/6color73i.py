@@ -1,124 +1,319 @@
-from PIL import Image
+from PIL import Image, ImageOps
 import numpy as np
+import os
+import struct
 import sys
+import tempfile
+import time
 
-def main():
-    # Check if there are exactly 4 arguments (script name, orientation, input file, and output file)
-    if len(sys.argv) != 4:
-        print("Usage: python 6color73i.py orientation input_image.jpg output_file.h")
-        return
+# Panel resolution
+WIDTH = 800
+HEIGHT = 480
 
-    orientation = sys.argv[1].lower()
-    input_file = sys.argv[2]
-    output_file = sys.argv[3]
+# EXIF orientations that turn the image a quarter, swapping width and height
+EXIF_ORIENTATION_TAG = 0x0112
+EXIF_TRANSPOSED = (5, 6, 7, 8)
+
+# Define the color palette
+PALETTE = [
+    (0, 0, 0),       # Black
+    (255, 255, 255), # White
+    (255, 0, 0),     # Red
+    (255, 255, 0),   # Yellow
+    (0, 255, 0),     # Green
+    (0, 0, 255)      # Blue
+]
+
+# EPD color byte for each palette entry, in palette order
+EPD_COLORS = np.array([
+    0x00,  # Black
+    0xFF,  # White
+    0xE0,  # Red
+    0xFC,  # Yellow
+    0x1C,  # Green
+    0x03   # Blue
+], dtype=np.uint8)
+
+# Palette as float32 for the nearest-color search and float64 for the error
+# terms, matching the precision the scalar Floyd-Steinberg loop used
+PALETTE_F32 = np.array(PALETTE, dtype=np.float32)
+PALETTE_F64 = np.array(PALETTE, dtype=np.float64)
+
+# Packed binary payload: magic, format version, width, height and palette size,
+# followed by an (R, G, B, EPD color) entry per palette color and then the
+# palette indices as 4-bit nibbles, two pixels per byte, high nibble first.
+BIN_MAGIC = b'EINK'
+BIN_VERSION = 1
+BIN_HEADER = struct.Struct('<4sBHHB')
+
+# C-header text of each EPD color byte, and the number of values per line
+HEADER_VALUES = np.array([list('0x{:02X},'.format(value).encode('ascii')) for value in range(256)], dtype=np.uint8)
+HEADER_VALUES_PER_LINE = 16
+
+# Error diffusion kernels as (row offset, column offset, weight), in the order
+# the error is spread to the neighbours
+FLOYD_STEINBERG_KERNEL = [(1, -1, 3 / 16), (0, 1, 7 / 16), (1, 0, 5 / 16), (1, 1, 1 / 16)]
+ATKINSON_KERNEL = [(0, 1, 1 / 8), (0, 2, 1 / 8), (1, -1, 1 / 8), (1, 0, 1 / 8), (1, 1, 1 / 8), (2, 0, 1 / 8)]
+
+# 8x8 Bayer threshold matrix for ordered dithering, centered on 0 in (-0.5, 0.5):
+# no threshold reaches -0.5, which would move a flat palette color halfway to
+# black and let the tie pick black
+BAYER_8 = (np.array([
+    [0, 32, 8, 40, 2, 34, 10, 42],
+    [48, 16, 56, 24, 50, 18, 58, 26],
+    [12, 44, 4, 36, 14, 46, 6, 38],
+    [60, 28, 52, 20, 62, 30, 54, 22],
+    [3, 35, 11, 43, 1, 33, 9, 41],
+    [51, 19, 59, 27, 49, 17, 57, 25],
+    [15, 47, 7, 39, 13, 45, 5, 37],
+    [63, 31, 55, 23, 61, 29, 53, 21]
+], dtype=np.float32) + 0.5) / 64 - 0.5
+
+# Every palette channel is either 0 or 255, so the threshold spreads over the full range
+ORDERED_SPREAD = 255
+
+
+def load_image(image, orientation):
+    """Decodes an opened image close to the size it is scaled to, upright and in RGB.
+
+    JPEG files are decoded with DCT scaling at the smallest 1/2, 1/4 or 1/8
+    scale that still covers the panel, so a camera original takes a fraction
+    of the memory and time of a full decode. Other formats are decoded in full.
+    """
+    # Size the decoded image must cover, before the rotations are applied
+    width, height = (HEIGHT, WIDTH) if orientation == "vertical" else (WIDTH, HEIGHT)
+    if image.getexif().get(EXIF_ORIENTATION_TAG) in EXIF_TRANSPOSED:
+        width, height = height, width
+
+    image.draft('RGB', (width, height))
+    return ImageOps.exif_transpose(image).convert('RGB')
 
-    # Open and convert the image to RGB
-    image = Image.open(input_file).convert('RGB')
 
+def prepare_image(image, orientation):
+    """Rotates, scales and center-crops an RGB image to the panel size."""
     # Rotate the image if orientation is vertical
     if orientation == "vertical":
         image = image.rotate(90, expand=True)
-    
+
     # Calculate the aspect ratio of the target size and the original image
-    target_ratio = 800 / 480
+    target_ratio = WIDTH / HEIGHT
     image_ratio = image.width / image.height
 
     # Determine scaling and cropping
     if image_ratio > target_ratio:
         # Image is wider than target, crop the width
-        new_height = 480
-        new_width = int(480 * image_ratio)
+        new_height = HEIGHT
+        new_width = int(HEIGHT * image_ratio)
     else:
         # Image is taller than target, crop the height
-        new_width = 800
-        new_height = int(800 / image_ratio)
+        new_width = WIDTH
+        new_height = int(WIDTH / image_ratio)
+
+    # Resize and center-crop to the target size; a large image is first reduced
+    # by an integer factor, so LANCZOS only works on about three times the target
+    image = image.resize((new_width, new_height), Image.LANCZOS, reducing_gap=3.0)
+    left = (new_width - WIDTH) / 2
+    top = (new_height - HEIGHT) / 2
+    right = (new_width + WIDTH) / 2
+    bottom = (new_height + HEIGHT) / 2
+    return image.crop((left, top, right, bottom))
+
+
+def nearest_colors(colors):
+    """Returns the index of the closest palette color for an (n, 3) float32 array."""
+    diff = PALETTE_F32[:, None, :] - colors
+    diff *= diff
+    return np.argmin(diff[:, :, 0] + diff[:, :, 1] + diff[:, :, 2], axis=0)
+
+
+def error_diffusion(pixels, kernel):
+    """Dithers an (height, width, 3) float32 array to palette indices by error diffusion.
+
+    Pixel (y, x) only depends on pixels that spread error to it, which for
+    these kernels all have a smaller x + 2 * y, so every pixel with the same
+    x + 2 * y can be quantized at once. Walking these anti-diagonals keeps the
+    per-pixel order of operations of a scalar loop, while doing one NumPy step
+    per diagonal.
+    """
+    height, width, _ = pixels.shape
+    indices = np.empty(height * width, dtype=np.uint8)
+
+    # Pad the sides and the bottom, so the error can always be diffused into
+    # every neighbour of the kernel; the padding is never read back.
+    left = max(0, -min(dx for _, dx, _ in kernel))
+    right = max(0, max(dx for _, dx, _ in kernel))
+    padded_width = width + left + right
+    padded = np.zeros((height + max(dy for dy, _, _ in kernel), padded_width, 3), dtype=np.float32)
+    padded[:height, left:left + width] = pixels
+    flat = padded.reshape(-1, 3)
+    offsets = [(dy * padded_width + dx, weight) for dy, dx, weight in kernel]
+
+    for step in range(width + 2 * (height - 1)):
+        ys = np.arange(max(0, (step - width + 2) // 2), min(height, step // 2 + 1))
+        xs = step - 2 * ys
+        positions = ys * padded_width + xs + left
+
+        # Find the closest palette color for every pixel on the diagonal
+        old = flat[positions]
+        best = nearest_colors(old)
+        indices[ys * width + xs] = best
+        quant_error = old - PALETTE_F64[best]
+
+        # Diffuse the error. The kernel order decides which share a pixel gets
+        # first when two pixels on the diagonal spread error to it.
+        for offset, weight in offsets:
+            flat[positions + offset] += quant_error * weight
+
+    return indices.reshape(height, width)
+
+
+def floyd_steinberg(pixels):
+    """Floyd-Steinberg dithers an (height, width, 3) float32 array to palette indices.
+
+    A pixel gets the 3/16 share from the row above before the 7/16 share from
+    its left neighbour, as in the scalar loop, so the output is identical.
+    """
+    return error_diffusion(pixels, FLOYD_STEINBERG_KERNEL)
+
 
-    # Resize and center-crop to the target size
-    image = image.resize((new_width, new_height), Image.LANCZOS)
-    left = (new_width - 800) / 2
-    top = (new_height - 480) / 2
-    right = (new_width + 800) / 2
-    bottom = (new_height + 480) / 2
-    image = image.crop((left, top, right, bottom))
+def atkinson(pixels):
+    """Atkinson dithers an (height, width, 3) float32 array to palette indices.
 
+    Only 6/8 of the error is diffused, which keeps more contrast than
+    Floyd-Steinberg at the cost of detail in the darkest and lightest areas.
+    """
+    return error_diffusion(pixels, ATKINSON_KERNEL)
+
+
+def ordered(pixels):
+    """Ordered (Bayer) dithers an (height, width, 3) float32 array to palette indices.
+
+    Every pixel is independent, so the whole image is done in one vectorized
+    step, which is much faster than error diffusion on large panels.
+    """
+    height, width, _ = pixels.shape
+    thresholds = np.tile(BAYER_8, (height // 8 + 1, width // 8 + 1))[:height, :width, None]
+    shifted = pixels + thresholds * ORDERED_SPREAD
+    return nearest_colors(shifted.reshape(-1, 3)).astype(np.uint8).reshape(height, width)
+
+
+# Dither algorithms by the name used in the screen type settings
+DITHER_ALGORITHMS = {
+    'floyd-steinberg': floyd_steinberg,
+    'atkinson': atkinson,
+    'ordered': ordered
+}
+
+
+def encode_bin(indices):
+    """Packs an array of palette indices into the binary frame payload."""
+    height, width = indices.shape
+    header = BIN_HEADER.pack(BIN_MAGIC, BIN_VERSION, width, height, len(PALETTE))
+    palette = b''.join(struct.pack('<BBBB', r, g, b, int(epd)) for (r, g, b), epd in zip(PALETTE, EPD_COLORS))
+
+    nibbles = indices.ravel()
+    if nibbles.size % 2:
+        nibbles = np.append(nibbles, 0)
+    packed = (nibbles[0::2] << 4) | nibbles[1::2]
+    return header + palette + packed.astype(np.uint8).tobytes()
+
+
+def encode_header(indices):
+    """Generates the C-header data for an array of palette indices as ASCII bytes.
+
+    The text of every EPD color byte is looked up in HEADER_VALUES and a
+    newline column is added, so no per-value Python code runs.
+    """
+    epd_colors = EPD_COLORS[indices].ravel()
+    full_lines = epd_colors.size - epd_colors.size % HEADER_VALUES_PER_LINE
+    lines = HEADER_VALUES[epd_colors[:full_lines]].reshape(-1, HEADER_VALUES_PER_LINE * HEADER_VALUES.shape[1])
+    return b''.join([
+        'const unsigned char imageData[{}] = {{\n'.format(epd_colors.size).encode('ascii'),
+        np.hstack([lines, np.full((len(lines), 1), ord('\n'), dtype=np.uint8)]).tobytes(),
+        # The last line has no newline of its own when it is not full
+        HEADER_VALUES[epd_colors[full_lines:]].tobytes() + b'\n};'
+    ])
+
+
+def write_atomic(path, data):
+    """Writes bytes to a temporary file next to path and renames it over path.
+
+    A reader that opens path, such as a frame downloading it, gets either the
+    previous file or the new one, never a partly written file.
+    """
+    folder = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(prefix='.' + os.path.basename(path) + '.', suffix='.tmp', dir=folder)
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            file.write(data)
+        # mkstemp creates the file readable by its owner only
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+def render(image, orientation, timings=None, dither='floyd-steinberg'):
+    """In-process entry point used by the image server.
+
+    Takes an opened PIL image, the screen orientation and the name of a dither
+    algorithm and returns the frame payloads keyed by file extension. If a
+    timings dict is passed, the seconds spent decoding, resizing, dithering and
+    encoding are stored in it.
+    """
+    if dither not in DITHER_ALGORITHMS:
+        raise ValueError(f"Unknown dither algorithm {dither!r}, use one of {', '.join(DITHER_ALGORITHMS)}")
+    if timings is None:
+        timings = {}
+
+    start_time = time.perf_counter()
+    image = load_image(image, orientation.lower())
+    timings['decode'] = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    image = prepare_image(image, orientation.lower())
     pixels = np.array(image, dtype=np.float32)
-    height, width, channels = pixels.shape
-
-    # Define the color palette
-    palette = [
-        (0, 0, 0),       # Black
-        (255, 255, 255), # White
-        (255, 0, 0),     # Red
-        (255, 255, 0),   # Yellow
-        (0, 255, 0),     # Green
-        (0, 0, 255)      # Blue
-    ]
-
-    def find_closest_color(r, g, b):
-        min_distance = float('inf')
-        closest_color = palette[0]
-        for color in palette:
-            distance = (color[0] - r) **2 + (color[1] - g) **2 + (color[2] - b) **2
-            if distance < min_distance:
-                min_distance = distance
-                closest_color = color
-        return closest_color
-
-    def color_to_epd_color(r, g, b):
-        if r > 200 and g > 200 and b > 200:
-            return 0xFF  # White
-        if r < 50 and g < 50 and b < 50:
-            return 0x00  # Black
-        if r > 200 and g < 50 and b < 50:
-            return 0xE0  # Red
-        if r < 50 and g > 200 and b < 50:
-            return 0x1C  # Green
-        if r < 50 and g < 50 and b > 200:
-            return 0x03  # Blue
-        if r > 200 and g > 200 and b < 50:
-            return 0xFC  # Yellow
-        return 0xFF  # Default to White
-
-    # Perform Floyd-Steinberg dithering
-    for y in range(height):
-        for x in range(width):
-            old_pixel = pixels[y, x].copy()
-            new_pixel = find_closest_color(*old_pixel)
-            pixels[y, x] = new_pixel
-            quant_error = old_pixel - new_pixel
-
-            if x + 1 < width:
-                pixels[y, x + 1] += quant_error * 7 / 16
-            if x - 1 >= 0 and y + 1 < height:
-                pixels[y + 1, x - 1] += quant_error * 3 / 16
-            if y + 1 < height:
-                pixels[y + 1, x] += quant_error * 5 / 16
-            if x + 1 < width and y + 1 < height:
-                pixels[y + 1, x + 1] += quant_error * 1 / 16
-
-    # Clip the pixel values to be in [0, 255]
-    pixels = np.clip(pixels, 0, 255)
-
-    # Generate the data string
-    image_size = width * height
-    data_string = 'const unsigned char imageData[{}] = {{\n'.format(image_size)
-    counter = 0
-    for y in range(height):
-        for x in range(width):
-            r, g, b = pixels[y, x]
-            epd_color = color_to_epd_color(r, g, b)
-            data_string += '0x{:02X},'.format(int(epd_color))
-            counter += 1
-            if counter % 16 == 0:
-                data_string += '\n'
-
-    data_string += '\n};'
-
-    # Save to specified output file
-    with open(output_file, 'w') as f:
-        f.write(data_string)
+    timings['resize'] = time.perf_counter() - start_time
+
+    # Map the image to the palette with the selected dither algorithm
+    start_time = time.perf_counter()
+    indices = DITHER_ALGORITHMS[dither](pixels)
+    timings['dither'] = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    payloads = {
+        '.h': encode_header(indices),
+        '.bin': encode_bin(indices)
+    }
+    timings['encode'] = time.perf_counter() - start_time
+    return payloads
+
+
+def main():
+    # Check for 4 or 5 arguments (script name, orientation, input file, output file and optionally the dither algorithm)
+    if len(sys.argv) not in (4, 5):
+        print("Usage: python 6color73i.py orientation input_image.jpg output_file.h [" + "|".join(DITHER_ALGORITHMS) + "]")
+        return
+
+    orientation = sys.argv[1].lower()
+    input_file = sys.argv[2]
+    output_file = sys.argv[3]
+    dither = sys.argv[4] if len(sys.argv) == 5 else 'floyd-steinberg'
+
+    with Image.open(input_file) as image:
+        payloads = render(image, orientation, dither=dither)
+
+    # Save to specified output file, replacing it only once it is complete
+    write_atomic(output_file, payloads['.h'])
 
     print("Data array saved to", output_file)
 
+    # Save the packed binary payload next to the header file
+    bin_file = os.path.splitext(output_file)[0] + '.bin'
+    write_atomic(bin_file, payloads['.bin'])
+
+    print("Binary payload saved to", bin_file)
+
 if __name__ == '__main__':
     main()
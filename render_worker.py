@@ -0,0 +1,99 @@
+"""Long-lived render worker, started by app.py and fed render requests over its stdin.
+
+Each request is a pickled (script path, image path, orientation, dither) tuple, and each
+reply a pickled (status, result, timings) tuple written to stdout:
+
+    ('ok', {file extension: payload bytes}, {stage: seconds})
+    ('cli-only', None, None)        the script has no render() entry point
+    ('unavailable', message, None)  the script could not be loaded
+    ('error', message, None)        render() raised an exception
+
+Screen-type scripts are imported once and reloaded when the file changes, so a render only
+pays for the image work. The worker exits when the server closes its stdin, and the server
+kills it when a render takes too long.
+"""
+import importlib.util
+import inspect
+import os
+import pickle
+import re
+import sys
+from PIL import Image
+
+# Screen-type renderers loaded from pyscripts, keyed by script path: (mtime, render function or None)
+renderer_cache = {}
+
+def get_renderer(script_path):
+    """Returns the render(image, orientation) entry point of a screen-type script, or None if it only has a CLI."""
+    mtime = os.path.getmtime(script_path)
+    cached = renderer_cache.get(script_path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    # Only import scripts that define render(), CLI-only scripts may do their work at import time
+    with open(script_path, 'r') as script_file:
+        if not re.search(r'^def render\(', script_file.read(), re.MULTILINE):
+            renderer_cache[script_path] = (mtime, None)
+            return None
+
+    # Load the script as a module; it is reloaded when the file changes
+    module_name = "pyscript_" + re.sub(r'\W', '_', os.path.splitext(os.path.basename(script_path))[0])
+    spec = importlib.util.spec_from_file_location(module_name, script_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    render = getattr(module, 'render', None)
+    if not callable(render):
+        render = None
+    renderer_cache[script_path] = (mtime, render)
+    return render
+
+def render_image(script_path, image_path, orientation, dither):
+    """Renders an image with a screen-type render() function and returns the reply for the server.
+
+    The image is passed undecoded, so the script can decode it at a reduced size. Scripts whose
+    render() takes a timings argument report their own stages (decode, resize, dither, encode),
+    and the dither algorithm is passed to scripts whose render() takes a dither argument.
+    """
+    try:
+        render = get_renderer(script_path)
+    except Exception as e:
+        return 'unavailable', str(e), None
+    if render is None:
+        return 'cli-only', None, None
+
+    parameters = inspect.signature(render).parameters
+    timings = {}
+    options = {}
+    if 'timings' in parameters:
+        options['timings'] = timings
+    if 'dither' in parameters:
+        options['dither'] = dither
+
+    try:
+        with Image.open(image_path) as image:
+            payloads = render(image, orientation, **options)
+    except Exception as e:
+        return 'error', str(e), None
+
+    # A plain bytes result is the header file, a dict maps file extensions to payloads
+    if isinstance(payloads, bytes):
+        payloads = {'.h': payloads}
+    return 'ok', payloads, timings
+
+def main():
+    # Replies go to the original stdout, anything the scripts print goes to stderr
+    replies = os.fdopen(os.dup(sys.stdout.fileno()), 'wb')
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    requests = sys.stdin.buffer
+
+    while True:
+        try:
+            script_path, image_path, orientation, dither = pickle.load(requests)
+        except EOFError:
+            break
+        pickle.dump(render_image(script_path, image_path, orientation, dither), replies, protocol=pickle.HIGHEST_PROTOCOL)
+        replies.flush()
+
+if __name__ == "__main__":
+    main()